@@ -0,0 +1,31 @@
+def compatibility_graph(waiting_pool, sport):
+    """Adjacency sets of mutually compatible users waiting for one sport."""
+    return {
+        entry.telegram_id: {candidate.telegram_id for candidate in waiting_pool.find_matches(entry)}
+        for entry in waiting_pool.waiting(sport)
+    }
+
+
+def plan_matches(waiting_pool, sport):
+    """Pair up one sport's waiting pool in a single pass.
+
+    Greedy maximal matching: users with the fewest compatible partners are paired first (so they are
+    not left out), each with their least-connected partner; ties go to whoever has waited longest.
+    Returns a list of (entry, entry) pairs.
+    """
+    graph = compatibility_graph(waiting_pool, sport)
+    entries = waiting_pool.entries
+    matched = set()
+    pairs = []
+
+    for telegram_id in sorted(graph, key=lambda telegram_id: (len(graph[telegram_id]), entries[telegram_id].seq)):
+        if telegram_id in matched:
+            continue
+        partners = [partner_id for partner_id in graph[telegram_id] if partner_id not in matched]
+        if not partners:
+            continue
+        partner_id = min(partners, key=lambda partner_id: (len(graph[partner_id]), entries[partner_id].seq))
+        matched.update((telegram_id, partner_id))
+        pairs.append((entries[telegram_id], entries[partner_id]))
+
+    return pairs
@@ -0,0 +1,124 @@
+"""Benchmark: candidate search with the old full-document scan vs the filtered, projected pipeline.
+
+Seeds a scratch database on a local mongod with a waiting pool of synthetic users, then runs both
+candidate searches for a sample of searchers and compares bytes received and latency. Both
+searches must find exactly the same candidates.
+
+Usage: python bench_candidate_query.py [--url mongodb://localhost:27017] [--users 10000] [--searchers 200]
+"""
+from pymongo import MongoClient, monitoring
+import argparse
+import bson
+import statistics
+import sys
+import time
+
+from candidate_query import build_candidate_pipeline
+from indexes import ensure_indexes
+from matching_pool import PoolEntry
+from preferences import SportPreferences, compile_match_preferences
+from synthetic_users import generate_users
+
+
+# Counts the size of every server reply, which is what came over the wire
+class ReplyBytes(monitoring.CommandListener):
+    def __init__(self):
+        self.bytes = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.bytes += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        pass
+
+
+def entry_for(user, sport):
+    # Compiled from scratch on purpose: the old loop re-parsed every candidate's preferences
+    compiled = compile_match_preferences(user.get("matchPreferences")) or {}
+    return PoolEntry(user, sport, 0, compiled.get(sport, SportPreferences()))
+
+
+def scan_all(users, searcher):
+    """The original sport_selected loop: fetch every waiting user for the sport, check in Python."""
+    matches = []
+    for potential_match in users.find({"telegramId": {"$ne": searcher.telegram_id}, "wantToBeMatched": True, "selectedSport": searcher.sport}):
+        candidate = entry_for(potential_match, searcher.sport)
+        if searcher.matches(candidate):
+            matches.append(candidate.telegram_id)
+    return matches
+
+
+def filtered_pipeline(users, searcher):
+    pipeline = build_candidate_pipeline(searcher.telegram_id, searcher.sport, searcher.preferences)
+    if pipeline is None:
+        return []
+    matches = []
+    for potential_match in users.aggregate(pipeline):
+        candidate = entry_for(potential_match, searcher.sport)
+        if searcher.matches(candidate):
+            matches.append(candidate.telegram_id)
+    return matches
+
+
+def measure(name, search, users, searchers, listener):
+    latencies = []
+    results = {}
+    listener.bytes = 0
+    for searcher in searchers:
+        started = time.perf_counter()
+        results[searcher.telegram_id] = sorted(search(users, searcher))
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(
+        f"{name:<18} {listener.bytes / len(searchers) / 1024:10.1f} KiB/search"
+        f" {statistics.mean(latencies):9.2f} ms mean {statistics.median(latencies):9.2f} ms p50 {p99:9.2f} ms p99"
+    )
+    return results
+
+
+def main(args):
+    listener = ReplyBytes()
+    client = MongoClient(args.url, event_listeners=[listener])
+    client.drop_database(args.db)
+    db = client[args.db]
+    users = db["User"]
+
+    print(f"Seeding {args.users} waiting users into {args.db}...")
+    population = generate_users(args.users, seed=args.seed, waiting=True)
+    users.insert_many(population)
+    ensure_indexes(db)
+
+    searchers = []
+    for user in population[:args.searchers]:
+        sport = user["selectedSport"]
+        searchers.append(entry_for(user, sport))
+
+    scanned = measure("full scan", scan_all, users, searchers, listener)
+    filtered = measure("filtered pipeline", filtered_pipeline, users, searchers, listener)
+
+    client.drop_database(args.db)
+    if scanned != filtered:
+        different = [telegram_id for telegram_id in scanned if scanned[telegram_id] != filtered[telegram_id]]
+        print(f"ERROR: the searches disagree for {len(different)} searchers, e.g. {different[:5]}")
+        return 1
+    print(f"Both searches found the same candidates for all {len(searchers)} searchers.")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="mongodb://localhost:27017", help="local mongod to run against")
+    parser.add_argument("--db", default="sportsfinder_bench", help="scratch database, dropped before and after the run")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--searchers", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.db == "test_database":
+        sys.exit("Refusing to run against the bot's own database")
+    sys.exit(main(args))
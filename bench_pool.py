@@ -0,0 +1,51 @@
+"""Benchmark: memory per waiting user and cost of the mutual compatibility check in the waiting pool.
+
+Usage: python bench_pool.py [--users 50000] [--pairs 1000000]
+"""
+import argparse
+import copy
+import random
+import time
+import tracemalloc
+
+from matching_pool import WaitingPool
+from preferences import PreferenceCache
+from synthetic_users import generate_users
+
+
+def main(args):
+    users = generate_users(args.users, seed=args.seed, waiting=True)
+    cache = PreferenceCache()
+    for user in users:
+        cache.get_sport(user, user["selectedSport"])  # Compiled preferences are shared with the cache, keep them out of the measurement
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    # Fresh copies, as the bot gets them from MongoDB: whatever the pool keeps a reference to stays allocated
+    documents = copy.deepcopy(users)
+    pool = WaitingPool()
+    for user in documents:
+        pool.add(user, user["selectedSport"], cache.get_sport(user, user["selectedSport"]))
+    del documents
+    pool_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{len(pool.entries)} waiting users, {pool_bytes / len(pool.entries):.0f} bytes per user in the pool")
+
+    rng = random.Random(args.seed)
+    entries = list(pool.entries.values())
+    pairs = [(rng.choice(entries), rng.choice(entries)) for _ in range(args.pairs)]
+    started = time.perf_counter()
+    sum(1 for a, b in pairs if a is b)
+    loop = time.perf_counter() - started  # Cost of the loop itself, subtracted below
+    started = time.perf_counter()
+    compatible = sum(1 for a, b in pairs if a.matches(b))
+    elapsed = time.perf_counter() - started - loop
+    print(f"{elapsed / len(pairs) * 1e9:.0f} ns per mutual check, {compatible} of {len(pairs)} pairs compatible")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--pairs", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
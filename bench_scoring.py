@@ -0,0 +1,69 @@
+"""Benchmark: candidate ranking modes on a large in-memory waiting pool.
+
+Fills a WaitingPool with synthetic users, then for a sample of searchers finds the mutually compatible
+candidates and ranks them with every scorer in scoring.py. Reports the time per search and how close the
+candidate tried first is to the searcher (age gap, skill gap, shared locations).
+
+Usage: python bench_scoring.py [--users 50000] [--searchers 200] [--single-sport]
+"""
+import argparse
+import statistics
+import time
+
+from matching_pool import WaitingPool, popcount
+from preferences import PreferenceCache, normalize_match_preferences
+from scoring import SCORERS, SKILL_RANK, UNKNOWN_SKILL_RANK
+from synthetic_users import SPORTS, generate_users
+
+
+def move_to_sport(user, sport):
+    """Make a user wait for `sport`, carrying over their skill level and preferences of another sport."""
+    own_sport = next(iter(user["sports"]))
+    preferences = normalize_match_preferences(user["matchPreferences"]) or {}
+    user["sports"] = {sport: user["sports"][own_sport]}
+    user["matchPreferences"] = {sport: preferences.get(own_sport, {})}
+    user["selectedSport"] = sport
+
+
+def main(args):
+    users = generate_users(args.users, seed=args.seed, waiting=True)
+    if args.single_sport:
+        for user in users:
+            move_to_sport(user, SPORTS[0])
+
+    cache = PreferenceCache()
+    pool = WaitingPool()
+    for user in users:
+        pool.add(user, user["selectedSport"], cache.get_sport(user, user["selectedSport"]))
+    print(f"{len(pool.entries)} users waiting in {len(pool.sports)} sports")
+
+    searchers = [pool.get(user["telegramId"]) for user in users[::max(1, len(users) // args.searchers)]][:args.searchers]
+    for name, scorer in SCORERS.items():
+        timings, age_gaps, skill_gaps, shared = [], [], [], []
+        for searcher in searchers:
+            started = time.perf_counter()
+            ranked = scorer(searcher, pool.find_matches(searcher))
+            first = next(iter(ranked), None)
+            timings.append(time.perf_counter() - started)
+            if first is not None:
+                age_gaps.append(abs(first.age - searcher.age))
+                skill_gaps.append(abs(
+                    SKILL_RANK.get(first.skill_level, UNKNOWN_SKILL_RANK) - SKILL_RANK.get(searcher.skill_level, UNKNOWN_SKILL_RANK)
+                ))
+                shared.append(popcount(first.location_mask & searcher.location_mask))
+
+        timings.sort()
+        print(
+            f"{name:<10} {statistics.mean(timings) * 1000:8.2f} ms mean {timings[int(len(timings) * 0.99)] * 1000:8.2f} ms p99"
+            f" | first candidate: age gap {statistics.mean(age_gaps or [0]):.1f}, skill gap {statistics.mean(skill_gaps or [0]):.2f},"
+            f" shared locations {statistics.mean(shared or [0]):.2f} ({len(age_gaps)} searchers had candidates)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--searchers", type=int, default=200)
+    parser.add_argument("--single-sport", action="store_true", help="everyone waits for the same sport")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,161 @@
+"""Offline end-to-end benchmark of the bot's handlers.
+
+Runs the real handlers of bot.py on real Update objects, with Telegram replaced by OfflineBot (see
+offline.py) and MongoDB by a local mongod or an in-memory store. A population of synthetic users goes
+through /matchme, the sport buttons, message relaying, /endmatch and the feedback buttons, each phase
+fired concurrently, and the per-handler latency, throughput and MongoDB round trips are reported.
+The run fails if a handler raises or needs more round trips than its ROUND_TRIP_BUDGET.
+
+Usage: python benchmark.py [--store memory|mongod] [--url mongodb://localhost:27017] [--users 500]
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+import callback_tokens
+import offline
+from database import round_trips
+from synthetic_users import generate_users
+
+# Most MongoDB round trips one update of a handler may take, checked on every run
+ROUND_TRIP_BUDGET = {
+    "match_me": 1,
+    "forward_message": 0,  # routes are cached from match creation
+    "end_match": 2,  # end the match and return it, then reset both users
+    "feedback_response": 0,  # signed buttons and buffered writes
+    "bot_experience_response": 0,
+    "user_experience_response": 0,
+    "no_game_reason_response": 0,
+}
+
+
+class Recorder:
+    def __init__(self, application, budgets=ROUND_TRIP_BUDGET):
+        self.application = application
+        self.budgets = budgets
+        self.timings = defaultdict(list)  # handler name -> seconds per update
+        self.wall_time = defaultdict(float)  # handler name -> seconds spent in phases running it
+        self.round_trips = defaultdict(list)  # handler name -> MongoDB operations per update
+        self.handler_errors = offline.handler_errors(application)  # Exceptions process_update caught
+        self.failures = 0  # Exceptions out of process_update and exceeded budgets
+
+    @property
+    def errors(self):
+        return self.failures + self.handler_errors.total
+
+    async def process(self, update):
+        name = offline.handler_name(self.application, update)
+        operations = Counter()
+        round_trips.set(operations)  # process() runs as its own task, so this only counts this update
+        started = time.perf_counter()
+        try:
+            await self.application.process_update(update)
+        except Exception as e:
+            self.failures += 1
+            print(f"Error in {name}: {e!r}")
+        self.timings[name].append(time.perf_counter() - started)
+        self.round_trips[name].append(sum(operations.values()))
+
+        budget = self.budgets.get(name)
+        if budget is not None and sum(operations.values()) > budget:
+            self.failures += 1
+            print(f"{name} took {sum(operations.values())} round trips, the budget is {budget}: {dict(operations)}")
+        return name
+
+    async def phase(self, updates):
+        started = time.perf_counter()
+        names = await asyncio.gather(*(self.process(update) for update in updates))
+        elapsed = time.perf_counter() - started
+        for name in set(names):
+            self.wall_time[name] += elapsed
+
+    def report(self):
+        print(f"{'handler':<26}{'updates':>8}{'per s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'db ops':>8}{'max':>5}{'errors':>8}")
+        for name, timings in sorted(self.timings.items()):
+            timings = sorted(timings)
+            throughput = len(timings) / self.wall_time[name] if self.wall_time[name] else 0.0
+            print(
+                f"{name:<26}{len(timings):>8}{throughput:>10.0f}{sum(timings) / len(timings) * 1000:>10.2f}"
+                f"{offline.percentile(timings, 0.5) * 1000:>10.2f}{offline.percentile(timings, 0.99) * 1000:>10.2f}"
+                f"{sum(self.round_trips[name]) / len(timings):>8.2f}{max(self.round_trips[name]):>5}{self.handler_errors.counts[name]:>8}"
+            )
+
+
+async def tap_keyboards(recorder, offline_bot, users, prefixes, rng):
+    """Every user whose last inline keyboard is one of `prefixes` taps one of its buttons."""
+    updates = []
+    for user in users:
+        buttons = offline_bot.last_keyboard(user["telegramId"])
+        if buttons and buttons[0].startswith(prefixes):
+            updates.append(offline.callback_update(offline_bot, user, rng.choice(buttons)))
+    await recorder.phase(updates)
+    return len(updates)
+
+
+async def main(args):
+    bot = offline.import_bot(args.store, args.url, args.db)
+    offline_bot = offline.OfflineBot(api_latency=args.api_latency_ms / 1000)
+    application = offline.build_application(bot, offline_bot)
+    await application.initialize()
+    await bot.on_startup(application)
+
+    users = generate_users(args.users, seed=args.seed)
+    await bot.database.run(bot.database.db["User"].insert_many, [dict(user) for user in users])
+    rng = random.Random(args.seed)
+    recorder = Recorder(application)
+    started = time.perf_counter()
+
+    await recorder.phase([offline.message_update(offline_bot, user, "/matchme") for user in users])
+    await tap_keyboards(recorder, offline_bot, users, ("sport_",), rng)
+    await bot.outbox.stop()
+
+    matches = await bot.matches_collection.find({"status": "active"})
+    matched_ids = {telegram_id for match in matches for telegram_id in (match["userAId"], match["userBId"])}
+    matched = [user for user in users if user["telegramId"] in matched_ids]
+    print(f"{len(matches)} matches between {len(users)} users")
+
+    for number in range(args.messages):
+        await recorder.phase([offline.message_update(offline_bot, user, f"Message {number} from {user['displayName']}") for user in matched])
+    for kind in offline.MEDIA if args.media else ():
+        await recorder.phase([offline.media_update(offline_bot, user, kind) for user in matched])
+    await bot.outbox.stop()
+
+    # One side of every match ends it, then both sides answer the feedback questions
+    enders = {match["userAId"] for match in matches}
+    await recorder.phase([offline.message_update(offline_bot, user, "/endmatch") for user in matched if user["telegramId"] in enders])
+    await bot.outbox.stop()
+    questions = (
+        (callback_tokens.GAME_PLAYED,),
+        (callback_tokens.BOT_EXPERIENCE, callback_tokens.NO_GAME_REASON),
+        (callback_tokens.USER_EXPERIENCE,),
+    )
+    for kinds in questions:
+        prefixes = tuple(f"{kind}." for kind in kinds)
+        await tap_keyboards(recorder, offline_bot, matched, prefixes, rng)
+        await bot.outbox.stop()
+
+    elapsed = time.perf_counter() - started
+    updates = sum(len(timings) for timings in recorder.timings.values())
+    print(f"{updates} updates in {elapsed:.2f}s ({updates / elapsed:.0f}/s), {len(offline_bot.calls)} Bot API calls, {recorder.errors} errors")
+    recorder.report()
+
+    await bot.on_shutdown(application)
+    await application.shutdown()
+    return 1 if recorder.errors else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--store", choices=["memory", "mongod"], default="memory", help="in-memory store (needs mongomock) or a local mongod")
+    parser.add_argument("--url", default="mongodb://localhost:27017", help="local mongod for --store mongod")
+    parser.add_argument("--db", default="sportsfinder_bench", help="scratch database, dropped before the run")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=5, help="messages relayed by every matched user")
+    parser.add_argument("--no-media", dest="media", action="store_false", help="skip relaying one of each offline.MEDIA kind")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Telegram response time")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
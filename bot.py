@@ -1,7 +1,6 @@
-from pymongo import MongoClient
 import os
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Contact, Dice, Location, Poll, Sticker, Venue, VideoNote
 from telegram.ext import (
     CommandHandler,
     MessageHandler,
@@ -9,28 +8,269 @@ from telegram.ext import (
     Application,
     CallbackQueryHandler,
     ConversationHandler,
+    TypeHandler,
     ContextTypes,  # Import ContextTypes
 )
 from bson import ObjectId
-import json
+from pymongo import ReturnDocument
+from bson.errors import InvalidId
 import datetime
+import logging
+from database import AsyncDatabase
+from matching_pool import PoolEntry, WaitingPool
+from candidate_query import build_candidate_pipeline
+from batch_matcher import plan_matches
+from scoring import SCORERS
+from lanes import LaneApplication, UserLanes, wrap_handler_callbacks
+from outbox import Outbox
+from write_buffer import WriteBehindBuffer
+from user_sync import UserSync
+from broadcast import Broadcaster
+from update_log import UpdateRecorder
+from profiling import HandlerProfiler, ProfilingRequest
+from preferences import PreferenceCache
+from indexes import ensure_indexes, verify_query_plans
+from routing import DisplayNameCache, RoutingTable
+from sharding import shard_of
+from callback_tokens import FeedbackToken
+import callback_tokens
+from metrics import Gauge, serve as serve_metrics, time_handler
+from logging_setup import TraceSampler, configure_logging
 
 
 # Load environment variables from .env file
 load_dotenv()
 
 TOKEN = os.getenv("BOT_TOKEN")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public https base URL Telegram should post updates to (webhook mode)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")  # URL path the built-in listener serves
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Checked against the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Parallel connections Telegram may open to us
+PORT = int(os.getenv("PORT", "8443"))  # Set by Heroku for web dynos
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "0"))  # Updates handled at the same time, 0 handles them one by one
+MAX_QUEUED_UPDATES = int(os.getenv("MAX_QUEUED_UPDATES", "10000"))  # Updates waiting in user lanes before PTB stops starting more
+BOT_CONNECTION_POOL_SIZE = int(os.getenv("BOT_CONNECTION_POOL_SIZE", "256"))  # HTTP connections to the Bot API
+BOT_POOL_TIMEOUT = float(os.getenv("BOT_POOL_TIMEOUT", "5"))  # Seconds to wait for a free Bot API connection
+BOT_CONNECT_TIMEOUT = float(os.getenv("BOT_CONNECT_TIMEOUT", "5"))
+BOT_READ_TIMEOUT = float(os.getenv("BOT_READ_TIMEOUT", "10"))
 DATABASE_URL = os.getenv("DATABASE_URL")  # MongoDB connection string
-
-# Connect to MongoDB
-mongo_client = MongoClient(DATABASE_URL)
-db = mongo_client["test_database"]  # Use the database "sportsfinder"
-users_collection = db["User"]  # Use the collection "users"
-matches_collection = db["Match"]  # Use the collection "matches"
-feedback_collection = db["Feedback"]  # Use the collection "Feedback"
+DATABASE_NAME = os.getenv("DATABASE_NAME", "test_database")  # Use the database "sportsfinder"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))  # Max concurrent MongoDB operations
+DB_TIMEOUT_MS = int(os.getenv("DB_TIMEOUT_MS", "10000"))  # Timeout for a single MongoDB operation
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "10000"))  # Max matched users kept in the routing cache
+ROUTING_CACHE_TTL = int(os.getenv("ROUTING_CACHE_TTL", str(6 * 60 * 60)))  # Seconds an unused route is kept
+BATCH_MATCH_INTERVAL = int(os.getenv("BATCH_MATCH_INTERVAL", "60"))  # Seconds between batch matcher runs, 0 disables it
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))  # Set by sharding.py: which worker process this is
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))  # Set by sharding.py: how many worker processes share the updates
+MATCH_ENGINE = os.getenv("MATCH_ENGINE", "pool")  # "pool": in-memory waiting pool, "query": filtered MongoDB query
+MATCH_SCORING = os.getenv("MATCH_SCORING", "first_fit")  # "first_fit": first compatible candidate, "best": highest score (see scoring.py)
+USER_LANE_MAX_PENDING = int(os.getenv("USER_LANE_MAX_PENDING", "20"))  # Updates a single user may have queued
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))  # Messages per second across all chats (Telegram allows ~30)
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))  # Messages per second to a single chat
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))  # Messages a chat may receive back to back
+OUTBOX_MAX_QUEUED = int(os.getenv("OUTBOX_MAX_QUEUED", "10000"))
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET")  # Signs feedback buttons, derived from BOT_TOKEN if not set
+WRITE_BUFFER_INTERVAL = float(os.getenv("WRITE_BUFFER_INTERVAL", "2"))  # Max seconds a feedback write waits in memory
+WRITE_BUFFER_MAX_QUEUED = int(os.getenv("WRITE_BUFFER_MAX_QUEUED", "5000"))  # Max feedback writes a crash can lose
+USER_SYNC = os.getenv("USER_SYNC", "off")  # Follow web app edits: "off", "auto", "change_stream" or "poll"
+USER_SYNC_POLL_INTERVAL = float(os.getenv("USER_SYNC_POLL_INTERVAL", "5"))  # Seconds between updatedAt polls
+ADMIN_IDS = {int(telegram_id) for telegram_id in os.getenv("ADMIN_IDS", "").split(",") if telegram_id.strip()}  # Telegram ids allowed to /broadcast
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # Broadcast messages per second, keep it below OUTBOX_GLOBAL_RATE
+UPDATE_LOG_PATH = os.getenv("UPDATE_LOG_PATH")  # Record every incoming update to this file for replay.py, unset disables it
+UPDATE_LOG_MAX_BYTES = int(os.getenv("UPDATE_LOG_MAX_BYTES", str(50 * 1024 * 1024)))  # Size at which the update log rotates
+UPDATE_LOG_BACKUPS = int(os.getenv("UPDATE_LOG_BACKUPS", "10"))  # Rotated (gzipped) update logs kept
+UPDATE_LOG_ANONYMIZE = os.getenv("UPDATE_LOG_ANONYMIZE", "true").lower() == "true"  # Pseudonymous ids, no names or message text
+PROFILE_UPDATES = os.getenv("PROFILE_UPDATES", "false").lower() == "true"  # Start with profiling on, admins can switch it with /profiling
+PROFILE_EVERY = int(os.getenv("PROFILE_EVERY", "100"))  # Run 1 in N updates under cProfile while profiling, 0 never does
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "500"))  # Log a time breakdown of updates slower than this, 0 never does
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")  # Where the cProfile stats are written
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Port of the Prometheus /metrics endpoint, 0 disables it
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+CHECK_QUERY_PLANS = os.getenv("CHECK_QUERY_PLANS", "false").lower() == "true"  # Refuse to start if a query shape does a COLLSCAN
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # Per-module levels, e.g. "bot.matching=DEBUG,outbox=WARNING"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json"
+LOG_TRACE_SAMPLE_RATE = float(os.getenv("LOG_TRACE_SAMPLE_RATE", "0.01"))  # Share of per-candidate traces logged at DEBUG
+
+if MATCH_SCORING not in SCORERS:
+    raise SystemExit(f"MATCH_SCORING must be one of {', '.join(SCORERS)}")
+rank_candidates = SCORERS[MATCH_SCORING]
+
+# Structured, leveled logging (see logging_setup.py)
+configure_logging(LOG_LEVEL, LOG_LEVELS, LOG_FORMAT)
+logger = logging.getLogger("bot")
+# Matching decisions get their own logger, so they can be traced without the rest of the bot's DEBUG output
+matching_logger = logging.getLogger("bot.matching")
+candidate_trace = TraceSampler(matching_logger, LOG_TRACE_SAMPLE_RATE)
+
+# Connect to MongoDB (all calls run off the event loop, see database.py)
+database = AsyncDatabase(DATABASE_URL, DATABASE_NAME, pool_size=DB_POOL_SIZE, timeout_ms=DB_TIMEOUT_MS)
+users_collection = database.collection("User")  # Use the collection "users"
+matches_collection = database.collection("Match")  # Use the collection "matches"
+feedback_collection = database.collection("Feedback")  # Use the collection "Feedback"
+
+# Users currently waiting for a match, indexed per sport (see matching_pool.py)
+waiting_pool = WaitingPool()
+
+# Compiled match preferences per user, so matchPreferences JSON is parsed once per change (see preferences.py)
+preference_cache = PreferenceCache()
+
+# Where each matched user's messages are relayed to (see routing.py)
+routing_table = RoutingTable(max_size=ROUTING_CACHE_SIZE, ttl=ROUTING_CACHE_TTL)
+
+# Feedback writes are not needed right away, they are buffered and flushed in bulk (see write_buffer.py)
+write_buffer = WriteBehindBuffer(interval=WRITE_BUFFER_INTERVAL, max_queued=WRITE_BUFFER_MAX_QUEUED)
+
+# Display names of matched users, for feedback questions about the partner
+display_names = DisplayNameCache(max_size=ROUTING_CACHE_SIZE)
+
+# Key for the signed feedback buttons (see callback_tokens.py)
+callback_secret = CALLBACK_SECRET.encode() if CALLBACK_SECRET else callback_tokens.derive_secret(TOKEN)
+
+# Outgoing messages are queued here and sent within Telegram's rate limits (see outbox.py)
+outbox = Outbox(global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST, max_queued=OUTBOX_MAX_QUEUED)
+
+# A User document was changed outside this handler, e.g. a profile edit in the web apps (see user_sync.py)
+def apply_user_change(user):
+    telegram_id = user.get("telegramId")
+    if telegram_id is None:
+        return
+    preference_cache.invalidate(telegram_id)
+    if "displayName" in user:
+        display_names.refresh(telegram_id, user["displayName"])
+        routing_table.rename(telegram_id, user["displayName"])
+
+    # The caches above only update users they already hold, the pool only takes this worker's own users
+    sync_waiting_pool(telegram_id, user)
+
+# Whether this worker process handles the user's updates (see sharding.py), always true without sharding
+def owns_user(telegram_id):
+    return SHARD_COUNT <= 1 or shard_of(telegram_id, SHARD_COUNT) == SHARD_INDEX
+
+# Put a user into the waiting pool or take them out of it, whichever their User document says
+def sync_waiting_pool(telegram_id, user):
+    sport = user.get("selectedSport") if user else None
+    if user and owns_user(telegram_id) and user.get("wantToBeMatched") and not user.get("isMatched") and sport:
+        waiting_pool.refresh(user, sport, preference_cache.get_sport(user, sport))
+    else:
+        waiting_pool.remove(telegram_id)
+
+# A claim failed for these users, which can be temporary (a concurrent searcher claimed them and then
+# had to release them again): only users MongoDB says are no longer waiting leave the pool
+async def resync_waiting_pool(telegram_ids):
+    users = await users_collection.find({"telegramId": {"$in": list(telegram_ids)}})
+    by_id = {user["telegramId"]: user for user in users}
+    for telegram_id in telegram_ids:
+        sync_waiting_pool(telegram_id, by_id.get(telegram_id))
+
+# Another worker process changed this user's match state, drop what this one cached about them (see sharding.py)
+def forget_user(telegram_id):
+    routing_table.discard(telegram_id)
+    waiting_pool.remove(telegram_id)
+
+# Set by sharding.py in worker processes: sends forget_user for the given users to the workers that own them
+forget_elsewhere = None
+
+def forget_in_other_shards(*telegram_ids):
+    if forget_elsewhere is not None:
+        forget_elsewhere(telegram_ids)
+
+user_sync = UserSync(database, apply_user_change, mode=USER_SYNC, poll_interval=USER_SYNC_POLL_INTERVAL)
+
+# Admin announcements to every user, checkpointed in the Broadcast collection (see broadcast.py)
+broadcaster = Broadcaster(database, outbox, rate=BROADCAST_RATE, shard=SHARD_INDEX)
+
+# Gauges read at scrape time (see metrics.py)
+async def count_active_matches():
+    return await matches_collection.count_documents({"status": "active"})
+
+Gauge("sportsfinder_waiting_users", "Users in the waiting pool", ["sport"],
+      collect=lambda: {(sport,): len(index.members) for sport, index in waiting_pool.sports.items()})
+Gauge("sportsfinder_active_matches", "Matches with status active", collect=count_active_matches)
+Gauge("sportsfinder_outbox_queued", "Outgoing Bot API calls waiting in the outbox", collect=lambda: outbox.queued)
+Gauge("sportsfinder_write_buffer_queued", "Feedback writes waiting to be flushed to MongoDB", collect=lambda: write_buffer.queued)
+Gauge("sportsfinder_routing_table_size", "Matched users in the routing cache", collect=lambda: len(routing_table))
+metrics_server = None
+
+# Add the users waiting in MongoDB to a pool, only the ones this worker process handles unless all_shards is set
+async def load_waiting_users(pool, all_shards=False):
+    for user in await users_collection.find({"wantToBeMatched": True, "isMatched": {"$ne": True}}):
+        if user.get("selectedSport") and (all_shards or owns_user(user["telegramId"])):
+            pool.add(user, user["selectedSport"], preference_cache.get_sport(user, user["selectedSport"]))
+
+# Load everyone who was already waiting before the bot (re)started into the waiting pool
+async def load_waiting_pool(application):
+    await load_waiting_users(waiting_pool)
+    logger.info("Loaded %d waiting users into the matching pool", len(waiting_pool.entries))
+
+# Runs once before the bot starts receiving updates
+async def on_startup(application):
+    global metrics_server
+    outbox.start(application.bot)
+    write_buffer.start()
+    if METRICS_PORT:
+        metrics_server = await serve_metrics(METRICS_LISTEN, METRICS_PORT)
+        logger.info("Serving metrics on %s:%d/metrics", METRICS_LISTEN, METRICS_PORT)
+    await database.run(ensure_indexes, database.db)
+    if CHECK_QUERY_PLANS:
+        await database.run(verify_query_plans, database.db)
+    # Query-mode searches only read MongoDB, the pool is then only needed by the batch matcher
+    if MATCH_ENGINE != "query" or BATCH_MATCH_INTERVAL > 0:
+        await load_waiting_pool(application)
+    if USER_SYNC != "off":
+        await user_sync.start()
+    await broadcaster.resume()  # Each worker process resumes the broadcasts it started
+
+    # Periodically pair up users who are all waiting, so nobody has to re-run /matchme
+    if BATCH_MATCH_INTERVAL > 0:
+        if application.job_queue is None:
+            logger.warning("The job queue is not available, install python-telegram-bot[job-queue] to run the batch matcher")
+        else:
+            application.job_queue.run_repeating(run_batch_matcher, interval=BATCH_MATCH_INTERVAL, first=BATCH_MATCH_INTERVAL)
+
+# Stop the metrics endpoint and broadcasts, flush queued messages and buffered writes, then release the MongoDB connections and worker threads when the bot stops
+async def on_shutdown(application):
+    if metrics_server is not None:
+        metrics_server.close()
+    await user_sync.stop()
+    await broadcaster.stop()
+    if outbox.queued:
+        # The bot's HTTP client is already closed at this point, reopen it to deliver what is left
+        await application.bot.initialize()
+        await outbox.stop()
+        await application.bot.shutdown()
+    await write_buffer.stop()
+    if update_recorder is not None:
+        update_recorder.close()
+    database.close()
+
+# Tell a user whose updates arrive faster than they are handled to slow down
+async def lane_full(telegram_id):
+    outbox.send_message(telegram_id, "You're sending messages faster than I can handle them, please wait a moment for my replies.")
+
+# Run each user's updates strictly in order, while different users are handled in parallel (see lanes.py)
+user_lanes = UserLanes(max_pending=USER_LANE_MAX_PENDING, on_overflow=lane_full)
 
 # Create the Telegram Bot application
-application = Application.builder().token(TOKEN).build()
+application = (
+    Application.builder()
+    # CONCURRENT_UPDATES is enforced by LaneApplication, PTB's own limit only bounds the updates waiting in lanes
+    .application_class(LaneApplication, {"user_lanes": user_lanes, "running_updates": CONCURRENT_UPDATES})
+    .token(TOKEN)
+    .concurrent_updates(MAX_QUEUED_UPDATES if CONCURRENT_UPDATES else 0)
+    # Bot API calls go through ProfilingRequest so profiling can tell Telegram's share of an update
+    .request(ProfilingRequest(
+        connection_pool_size=BOT_CONNECTION_POOL_SIZE,
+        pool_timeout=BOT_POOL_TIMEOUT,
+        connect_timeout=BOT_CONNECT_TIMEOUT,
+        read_timeout=BOT_READ_TIMEOUT,
+    ))
+    .post_init(on_startup)
+    .post_shutdown(on_shutdown)
+    .build()
+)
 
 # Mapping reason numbers to their full text descriptions
 NO_GAME_REASONS = {
@@ -41,6 +281,11 @@ NO_GAME_REASONS = {
     "5": "Others"
 }
 
+# (label, answer) of the feedback question buttons
+GAME_PLAYED_OPTIONS = [("Yes", "yes"), ("No", "no")]
+RATING_OPTIONS = [(f"⭐ {rating}", rating) for rating in callback_tokens.RATINGS]
+NO_GAME_REASON_OPTIONS = [(reason_text, reason) for reason, reason_text in NO_GAME_REASONS.items()]
+
 # Function to handle /start command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
@@ -48,7 +293,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_username = update.message.from_user.username or "Unknown"
 
     # Check if the user exists in MongoDB
-    existing_user = users_collection.find_one({"telegramId": user_telegram_id})
+    existing_user = await users_collection.find_one({"telegramId": user_telegram_id})
 
     if not existing_user:
         # First-time user
@@ -85,7 +330,7 @@ async def edit_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
 
     # Fetch the user's document from MongoDB
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_one({"telegramId": user_telegram_id})
     # Use the displayName from MongoDB, or fallback to first_name if not available
     user_display_name = user.get("displayName", update.message.from_user.first_name or "Unknown")
 
@@ -132,7 +377,7 @@ async def match_preferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # /matchme function
 async def match_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_one({"telegramId": user_telegram_id})
 
     if not user:
         await update.message.reply_text("Please complete your profile first!")
@@ -179,171 +424,60 @@ async def sport_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     sport = query.data.split("_")[1]  # Extract the selected sport
     user_telegram_id = query.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_one({"telegramId": user_telegram_id})
 
     if not user:
         await query.edit_message_text("User not found.")
         return
     
     # Retrieve the current user's match preferences for the selected sport
-    match_preferences = user.get("matchPreferences", {})
-
-    # Convert from string to dictionary 
-    if isinstance(match_preferences, str):
-        try:
-            match_preferences = json.loads(match_preferences)  # Convert JSON string to dictionary
-        except json.JSONDecodeError:
-            print("Error: matchPreference is not a valid JSON format.")
-            match_preferences = {}  # Fallback to an empty dictionary
-
-    print("Match Preferences:", match_preferences) 
-
-    sport_preferences = match_preferences.get(sport, {})
-    print("Sport Preferences for", sport, ":", sport_preferences)
-
-    # Extract preferences
-    age_range = sport_preferences.get("ageRange", [1, 100])  # Default age range if not specified
-    gender_preference = sport_preferences.get("genderPreference", "No preference")
-    skill_levels = sport_preferences.get("skillLevels", [])
-    location_preferences = sport_preferences.get("locationPreferences", [])
-    location_preferences = set(location_preferences)  # Convert to set
-
-    print(f"Current user's preferences for {sport}: Age={age_range}, Gender={gender_preference}, Skills={skill_levels}, Locations={location_preferences}")  # Debugging
+    sport_preferences = preference_cache.get_sport(user, sport)
+    matching_logger.debug("Sport preferences of %s for %s: %s", user_telegram_id, sport, sport_preferences)
     
     # Send the "Gotcha! Sportsfinding for you..." message
     await query.edit_message_text(f"Gotcha! Sportsfinding your player in {sport}...")
 
     # Mark the user as wanting to be matched for the selected sport
-    users_collection.update_one(
+    await users_collection.update_one(
         {"telegramId": user_telegram_id},
         {"$set": {"wantToBeMatched": True, "selectedSport": sport}}
     )
+    searcher = waiting_pool.add(user, sport, sport_preferences)
 
-    # Find an ideal match based on users who also want to be matched for the same sport
-    # Iterate through the users_collection to find a suitable match
-    for potential_match in users_collection.find({
-        "telegramId": {"$ne": user_telegram_id},  # Not the same user
-        "wantToBeMatched": True,  # Only match with users who want to be matched
-        "selectedSport": sport,  # Match for the same sport
-    }):
-        
-        #extract out the location preferences in sports preferences for potential match
-        potential_match_preferences = potential_match.get("matchPreferences", {})
-        # Convert from string to dictionary 
-        if isinstance(potential_match_preferences, str):
-            try:
-                potential_match_preferences = json.loads(potential_match_preferences)  # Convert JSON string to dictionary
-            except json.JSONDecodeError:
-                print("Error: matchPreference is not a valid JSON format.")
-                potential_match_preferences = {}  # Fallback to an empty dictionary
-        
-        potential_sport_preferences = potential_match_preferences.get(sport, {})
-        potential_location_preferences = potential_sport_preferences.get("locationPreferences", [])
-        potential_location_preferences = set(potential_location_preferences)  # Convert to set
-        
-        # Extract the skill level for the selected sport from the potential match's sports data
-        potential_match_sports = potential_match.get("sports", {})
-        potential_match_skill_level = potential_match_sports.get(sport, "Unknown")  # Default to "Unknown
-        potential_match_age = int(potential_match.get("age", 0))
-
-        print("\n➡️ Checking potential match:", potential_match.get("username", "Unknown"))
-        print("  - Gender:", potential_match.get("gender"))
-        print("  - Age:", potential_match_age)
-        print(f"  - Skill Level for {sport}: {potential_match_skill_level}")
-        print("  - Location:", potential_location_preferences)
-
-        # Evaluate each condition separately
-        gender_condition = (gender_preference in ["No preference", "Either"] or potential_match.get("gender") == gender_preference)
-        age_condition = (age_range[0] <= potential_match.get("age", 0) <= age_range[1])
-        skill_level_condition = (not skill_levels or potential_match_skill_level in skill_levels)
-        # Check if there is at least one common location
-        location_condition = len(location_preferences.intersection(potential_location_preferences)) > 0
-
-        # Print the result of each condition
-        print("\nChecking Conditions:")
-        print("  - Gender Condition:", gender_condition)
-        print("  - Age Condition:", age_condition)
-        print("  - Skill Level Condition:", skill_level_condition)
-        print("  - Location Condition:", location_condition)
-
-        if gender_condition and age_condition and skill_level_condition and location_condition:
-            print("All conditions matched! Proceeding with the match. (first if block)")
-
-            print("Match Preferences for potential match:", potential_match_preferences)  # Print match preferences
-            print("Sport Preferences for potential match", sport, ":", potential_sport_preferences)
-
-            # extract out the potential match preferences
-            #the 4 conditions to match (check potential match preferences to current user data)
-            potential_age_range = potential_sport_preferences.get("ageRange", [1, 100])
-            potential_gender_preference = potential_sport_preferences.get("genderPreference", "No preference")
-            potential_skill_levels = potential_sport_preferences.get("skillLevels", [])
-            print("potential match match preferences: age range", sport, ":", potential_age_range, "| Type:", type(potential_age_range))
-            print("potential match match preferences: gender preferences", sport, ":", potential_gender_preference, "| Type:", type(potential_gender_preference))
-            print("potential match match preferences: skill level", sport, ":", potential_skill_levels, "| Type:", type(potential_skill_levels))
-            print("potential match match preferences: location", sport, ":", potential_location_preferences, "| Type:", type(potential_location_preferences))
-
-            #user own data
-            user_age = int(user.get("age", 0))  # Extract user's age
-            user_gender = user.get("gender", None)
-            user_sports = user.get("sports", {})  # Extract user's sports dictionary
-            user_skill_level = user_sports.get(sport, "Unknown")  # Default to "Unknown" if sport is not found
-            # Print function that includes both values and their types
-            print("User Data Extraction:")
-            print(f"Age: {user_age} (Type: {type(user_age).__name__})")
-            print(f"Gender: {user_gender} (Type: {type(user_gender).__name__})")
-            print(f"Skill Level for {sport}: {user_skill_level} (Type: {type(user_skill_level).__name__})")    
-
-            # Evaluate each condition separately
-            potential_gender_condition = (potential_gender_preference in ["No preference", "Either"] or user_gender == potential_gender_preference)
-            potential_age_condition = (potential_age_range[0] <= user_age <= potential_age_range[1])
-            potential_skill_level_condition = (not potential_skill_levels or user_skill_level in potential_skill_levels)
-
-            # Print the result of each condition (second pairing)
-            print("Checking Conditions for potential match:")
-            print(":) Gender Condition:", potential_gender_condition)
-            print(":) Age Condition:", potential_age_condition)
-            print(":) Skill Level Condition:", potential_skill_level_condition)
-
-            if (potential_gender_condition and potential_age_condition and potential_skill_level_condition):
-                # A suitable match has been found
-                # Create a match entry using pymongo, including usernames for both users
-                match_document = {
-                    "userAId": user_telegram_id,
-                    "userBId": potential_match["telegramId"],
-                    "userAUsername": user.get("username", "Unknown"),
-                    "userBUsername": potential_match.get("username", "Unknown"),
-                    "sport": sport,
-                    "status": "active"
-                }
-                matches_collection.insert_one(match_document)
-
-                # Update users as matched in pymongo and reset wantToBeMatched to False
-                users_collection.update_many(
-                    {"telegramId": {"$in": [user_telegram_id, potential_match["telegramId"]]}} ,
-                    {"$set": {"isMatched": True, "wantToBeMatched": False}}  # Set wantToBeMatched to False after matching
-                )
-
-                # Send the match info to the users
-                await context.bot.send_message(
-                    chat_id=user_telegram_id,
-                    text = f"You have been matched with {potential_match.get('displayName', 'Unknown')} ({potential_match_age}, {potential_match.get('gender')}) for {sport}! 🎉\nYou can now start chatting via this bot, type your messages below!"
-
-
-                )
-                await context.bot.send_message(
-                    chat_id=potential_match["telegramId"],
-                    text = f"You have been matched with {user.get('displayName', 'Unknown')} ({user_age}, {user.get('gender')}) for {sport}! 🎉\nYou can now start chatting via this bot, type your messages below!"
-
-                )
-                return  # Exit the function after a match is found
-            else:
-                print("second match fail")
-
-        else:
-            print("first match fail")
+    # Find an ideal match among the users waiting for the same sport
+    # Both engines only hand back candidates whose preferences match both ways
+    if MATCH_ENGINE == "query":
+        candidates = await find_candidates_in_db(searcher)
+    else:
+        candidates = waiting_pool.find_matches(searcher)
+
+    # Try the candidates in the order of the configured scoring, the first one that can still be claimed wins
+    for candidate in rank_candidates(searcher, candidates):
+        if candidate_trace.sampled():
+            matching_logger.debug("Candidate %s for %s in %s: %r", candidate.telegram_id, user_telegram_id, sport, candidate.preferences)
+
+        # A suitable match has been found
+        failed_claim = await create_match(searcher, candidate)
+        if failed_claim == user_telegram_id:
+            # create_match re-read this user: out of the pool means someone else matched them in the meantime
+            # (and notified them) or they stopped searching; still in it, their claim only lost a race
+            if waiting_pool.get(user_telegram_id) is None:
+                return
+            continue
+        if failed_claim is not None:
+            # The candidate is no longer available, try the next one
+            continue
+
+        # Send the match info to the users
+        matching_logger.info(
+            "Match found: %s <-> %s for %s", user.get("username", "Unknown"), candidate.username, sport,
+            extra={"user_id": user_telegram_id, "partner_id": candidate.telegram_id, "sport": sport},
+        )
+        send_match_notifications(searcher, candidate)
+        return  # Exit the function after a match is found
 
-    # If no suitable match is found after iterating through all users
-    await context.bot.send_message(
+    # If no suitable match is found in the waiting pool
+    outbox.send_message(
         chat_id=user_telegram_id,
         text=f"No match found for {sport} at the moment. Please wait for a match!"
     )
@@ -351,7 +485,7 @@ async def sport_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Handler for /endsearch command
 async def end_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_one({"telegramId": user_telegram_id})
     
     if not user:
         await update.message.reply_text("Please complete your profile first!")
@@ -370,12 +504,9 @@ async def end_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Get the sports the user is currently searching for (as string)
     sports_selected_str = user.get("selectedSport", "")
     
-    # Debug logging for sportsSelected
-    print(f"[DEBUG] sportsSelected value: {sports_selected_str}")  # Log the value
-    print(f"[DEBUG] sportsSelected type: {type(sports_selected_str)}")  # Log the type
+    logger.debug("selectedSport of %s: %r", user_telegram_id, sports_selected_str)
 
     if not sports_selected_str:
-        print(f"[DEBUG] sportsSelected is empty for user {user_telegram_id}")  # Debug log
         await update.message.reply_text("You are not currently searching for any sports.")
         return
     
@@ -403,92 +534,158 @@ async def end_search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     sport = data.split("_")[1]
     
     # Update MongoDB - set wantToBeMatched to false
-    users_collection.update_one(
+    await users_collection.update_one(
         {"telegramId": user_telegram_id},
         {"$set": {"wantToBeMatched": False}}
     )
+    waiting_pool.remove(user_telegram_id)
     
     await query.edit_message_text(f"OK, you have ended the search for {sport}.")
 
 # /endmatch function
 async def end_match(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
-
-    if not user:
-        await update.message.reply_text("Please complete your profile first!")
-        return
-
-    # Check if the user is currently matched
-    if not user.get("isMatched", False):
-        await update.message.reply_text("You are not currently matched with anyone!")
-        return
 
-    # Find the match document for the user
-    match_document = matches_collection.find_one({
-        "$or": [
-            {"userAId": user_telegram_id},
-            {"userBId": user_telegram_id}
-        ],
-        "status": "active"
-    })
+    # End the user's active match and get it back in a single round trip
+    match_document = await matches_collection.find_one_and_update(
+        {
+            "$or": [
+                {"userAId": user_telegram_id},
+                {"userBId": user_telegram_id}
+            ],
+            "status": "active"
+        },
+        {"$set": {"status": "ended"}},
+        projection={"userAId": 1, "userBId": 1},
+    )
 
     if not match_document:
-        await update.message.reply_text("No active match found!")
+        # Nothing to end, only now is the user read to explain why
+        user = await users_collection.find_one({"telegramId": user_telegram_id}, {"isMatched": 1})
+        if not user:
+            await update.message.reply_text("Please complete your profile first!")
+        elif not user.get("isMatched", False):
+            await update.message.reply_text("You are not currently matched with anyone!")
+        else:
+            await update.message.reply_text("No active match found!")
         return
 
-    # Update match status to "ended"
-    matches_collection.update_one(
-        {"_id": match_document["_id"]},
-        {"$set": {"status": "ended"}}
-    )
-
     # Update users' isMatched status and wantToBeMatched status
-    users_collection.update_many(
-        {"telegramId": {"$in": [user_telegram_id, match_document["userAId"], match_document["userBId"]]}},
-        {"$set": {"isMatched": False, "wantToBeMatched": False}}  # Reset both flags
+    user_a_id, user_b_id = match_document["userAId"], match_document["userBId"]
+    await users_collection.update_many(
+        {"telegramId": {"$in": [user_a_id, user_b_id]}},
+        {"$set": {"isMatched": False, "wantToBeMatched": False}, "$unset": {"activeMatchId": ""}}  # Reset both flags
     )
+    for telegram_id in (user_a_id, user_b_id):
+        waiting_pool.remove(telegram_id)
+        # Keep the names for the feedback questions about the partner
+        route = routing_table.get(telegram_id)
+        if route is not None:
+            display_names.set(telegram_id, route.display_name)
+        routing_table.discard(telegram_id)
+    forget_in_other_shards(user_a_id, user_b_id)
 
     # Send the match end message to both users
     await update.message.reply_text("Your match has ended.")
-    
-    other_user_id = match_document["userAId"] if match_document["userBId"] == user_telegram_id else match_document["userBId"]
-    other_user = users_collection.find_one({"telegramId": other_user_id})
-    
-    if other_user:
-        await context.bot.send_message(
-            chat_id=other_user["telegramId"],
-            text="The other sports-finder has ended the match."
-        )
-
-    # Ask both users for feedback
-    feedback_keyboard = [
-        [InlineKeyboardButton("Yes", callback_data=f"feedback_yes_{match_document['_id']}")],
-        [InlineKeyboardButton("No", callback_data=f"feedback_no_{match_document['_id']}")]
-    ]
-    feedback_markup = InlineKeyboardMarkup(feedback_keyboard)
 
-    await context.bot.send_message(
-        chat_id=user_telegram_id,
-        text="Was a game played?",
-        reply_markup=feedback_markup
-    )
-    await context.bot.send_message(
+    other_user_id = user_a_id if user_b_id == user_telegram_id else user_b_id
+    outbox.send_message(
         chat_id=other_user_id,
-        text="Was a game played?",
-        reply_markup=feedback_markup
+        text="The other sports-finder has ended the match."
     )
 
-# Function to forward messages between matched users
+    # Ask both users for feedback, each button already says which side of the match its user is on
+    for recipient_id, role, partner_id in ((user_a_id, "A", user_b_id), (user_b_id, "B", user_a_id)):
+        outbox.send_message(
+            chat_id=recipient_id,
+            text="Was a game played?",
+            reply_markup=feedback_markup(callback_tokens.GAME_PLAYED, match_document["_id"], role, partner_id, recipient_id, GAME_PLAYED_OPTIONS)
+        )
+
+# Admin only: /broadcast <text> sends the text to every user
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        return  # Not an admin, behave as if the command did not exist
+
+    parts = update.message.text.split(None, 1)
+    if len(parts) < 2:
+        await update.message.reply_text("Usage: /broadcast <message to send to every user>")
+        return
+
+    await broadcaster.start(parts[1], update.message.from_user.id)
+
+# Admin only: /profiling on [every N] [slow MS], /profiling off, or /profiling for the current settings
+async def profiling_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_IDS:
+        return  # Not an admin, behave as if the command did not exist
+
+    args = context.args or []
+    try:
+        if args and args[0] in ("on", "off"):
+            profiler.enabled = args[0] == "on"
+            options = dict(zip(args[1::2], args[2::2]))
+            if "every" in options:
+                profiler.every = int(options["every"])
+            if "slow" in options:
+                profiler.slow_seconds = float(options["slow"]) / 1000
+            logger.info("Profiling switched by %s: %s", update.message.from_user.id, profiler.status())
+        elif args:
+            raise ValueError(args[0])
+    except ValueError:
+        await update.message.reply_text("Usage: /profiling on [every N] [slow MS], /profiling off or /profiling")
+        return
+    await update.message.reply_text(profiler.status())
+
+# Attachments copy_message cannot put a caption on
+CAPTIONLESS_ATTACHMENTS = (Sticker, Location, Venue, Contact, VideoNote, Dice, Poll)
+MAX_CAPTION_LENGTH = 1024  # Telegram's limit for media captions
+
+# Function to forward messages between matched users, of any type
 async def forward_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = update.message.from_user.id
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+
+    # Matched users are routed from memory, MongoDB is only read on a cache miss
+    route = routing_table.get(user_telegram_id)
+    if route is None:
+        route = await load_route(user_telegram_id)
+        if route is None:
+            return  # The user is not matched, doesn't exist or has no active match
+
+    message = update.message
+    prefix = f"Message from {route.display_name}"
+    if message.text is not None:
+        # Forward the message to the other user
+        outbox.send_message(
+            chat_id=route.partner_id,
+            text=f"{prefix}: {message.text}"
+        )
+        return
+
+    # Anything else is copied by Telegram itself, the media never passes through the bot
+    if message.effective_attachment is not None and not isinstance(message.effective_attachment, CAPTIONLESS_ATTACHMENTS):
+        caption = f"{prefix}: {message.caption}" if message.caption else prefix
+        outbox.submit(
+            route.partner_id, "copy_message",
+            chat_id=route.partner_id, from_chat_id=message.chat_id, message_id=message.message_id,
+            caption=caption[:MAX_CAPTION_LENGTH],
+        )
+    else:
+        # Stickers, locations, contacts etc. cannot carry a caption, they get a header message instead
+        outbox.send_message(chat_id=route.partner_id, text=f"{prefix}:")
+        outbox.submit(
+            route.partner_id, "copy_message",
+            chat_id=route.partner_id, from_chat_id=message.chat_id, message_id=message.message_id,
+        )
+
+# Look up a user's active match in MongoDB and cache where their messages should go
+async def load_route(user_telegram_id):
+    user = await users_collection.find_one({"telegramId": user_telegram_id}, {"isMatched": 1, "displayName": 1})
 
     if not user or not user.get("isMatched", False):
-        return  # The user is not matched or doesn't exist
+        return None
     
     # Find the match document for the user
-    match_document = matches_collection.find_one({
+    match_document = await matches_collection.find_one({
         "$or": [
             {"userAId": user_telegram_id},
             {"userBId": user_telegram_id}
@@ -497,16 +694,59 @@ async def forward_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     })
 
     if not match_document:
-        return  # No active match found
+        return None
 
     # Determine the other user in the match
     other_user_id = match_document["userAId"] if match_document["userBId"] == user_telegram_id else match_document["userBId"]
+    return routing_table.set(user_telegram_id, other_user_id, user.get("displayName", "Unknown"), match_document["_id"])
+
+# Keyboard for a feedback question, every button is signed for the one user it is sent to (see callback_tokens.py)
+def feedback_markup(kind, match_id, role, partner_id, user_telegram_id, options):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=callback_tokens.encode(
+            callback_secret, FeedbackToken(kind, match_id, role, partner_id, answer), user_telegram_id
+        ))]
+        for label, answer in options
+    ])
+
+# Read the answer of a feedback button, signed buttons need no database reads
+async def read_feedback_token(query, kind):
+    user_telegram_id = query.from_user.id
+    if query.data.startswith(f"{kind}."):
+        token = callback_tokens.decode(callback_secret, query.data, user_telegram_id)
+        if token is None:
+            await query.edit_message_text("This button is no longer valid.")
+        return token
+
+    # Buttons sent before the tokens were introduced: <question>_<answer>_<match id>, look the match up
+    _, answer, match_id = query.data.rsplit("_", 2)
+    try:
+        match_id = ObjectId(match_id)
+    except InvalidId:
+        await query.edit_message_text("Invalid match ID.")
+        return None
 
-    # Forward the message to the other user
-    await context.bot.send_message(
-        chat_id=other_user_id,
-        text=f"Message from {user.get('displayName', 'Unknown')}: {update.message.text}"
-    )
+    match_document = await matches_collection.find_one({"_id": match_id})
+    if not match_document:
+        await query.edit_message_text("Match not found.")
+        return None
+
+    # Determine which user (A or B) provided the feedback
+    if user_telegram_id == match_document["userAId"]:
+        return FeedbackToken(kind, match_id, "A", match_document["userBId"], answer)
+    if user_telegram_id == match_document["userBId"]:
+        return FeedbackToken(kind, match_id, "B", match_document["userAId"], answer)
+    await query.edit_message_text("You are not part of this match.")
+    return None
+
+# Display name of a user, MongoDB is only read on a cache miss
+async def get_display_name(telegram_id):
+    display_name = display_names.get(telegram_id)
+    if display_name is None:
+        user = await users_collection.find_one({"telegramId": telegram_id}, {"displayName": 1})
+        display_name = user.get("displayName", "Unknown") if user else "Unknown"
+        display_names.set(telegram_id, display_name)
+    return display_name
 
 # Callback function when feedback is provided
 async def feedback_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -514,34 +754,14 @@ async def feedback_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()  # Acknowledge the callback query
 
     try:
-        # Extract the feedback and match ID from the callback data
-        feedback, match_id = query.data.split("_")[1], query.data.split("_")[2]
-        user_telegram_id = query.from_user.id
-
-        # Convert match_id to ObjectId
-        match_id = ObjectId(match_id)
-
-        # Find the match document
-        match_document = matches_collection.find_one({"_id": match_id})
-
-        if not match_document:
-            await query.edit_message_text("Match not found.")
+        token = await read_feedback_token(query, callback_tokens.GAME_PLAYED)
+        if token is None:
             return
+        feedback = token.answer
+        user_telegram_id = query.from_user.id
 
-        # Determine which user (A or B) provided the feedback
-        if user_telegram_id == match_document["userAId"]:
-            field_to_update = "gamePlayedA"
-        elif user_telegram_id == match_document["userBId"]:
-            field_to_update = "gamePlayedB"
-        else:
-            await query.edit_message_text("You are not part of this match.")
-            return 
-
-        # Update the match document with the feedback
-        matches_collection.update_one(
-            {"_id": match_id},
-            {"$set": {field_to_update: feedback}}
-        )
+        # Update the match document with the feedback, the token says whether the user is A or B
+        await write_buffer.set_fields(matches_collection, {"_id": token.match_id}, {f"gamePlayed{token.role}": feedback})
 
         # Notify the user that their feedback has been recorded
         await query.edit_message_text(f"Was the game played? You responded: {feedback}.")
@@ -549,38 +769,22 @@ async def feedback_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Ask follow-up questions based on the response
         if feedback == "yes":
             # Ask about the experience with the bot
-            bot_experience_keyboard = [
-                [InlineKeyboardButton("⭐ 1", callback_data=f"bot_experience_1_{match_id}")],
-                [InlineKeyboardButton("⭐ 2", callback_data=f"bot_experience_2_{match_id}")],
-                [InlineKeyboardButton("⭐ 3", callback_data=f"bot_experience_3_{match_id}")],
-                [InlineKeyboardButton("⭐ 4", callback_data=f"bot_experience_4_{match_id}")],
-                [InlineKeyboardButton("⭐ 5", callback_data=f"bot_experience_5_{match_id}")]
-            ]
-            bot_experience_markup = InlineKeyboardMarkup(bot_experience_keyboard)
-            await context.bot.send_message(
+            outbox.send_message(
                 chat_id=user_telegram_id,
                 text="How was your experience using SportsFinder’s bot?",
-                reply_markup=bot_experience_markup
+                reply_markup=feedback_markup(callback_tokens.BOT_EXPERIENCE, token.match_id, token.role, token.partner_id, user_telegram_id, RATING_OPTIONS)
             )
         else:
             # Ask why the game wasn't played
-            no_game_reasons_keyboard = [
-                [InlineKeyboardButton("Couldn’t find a common date", callback_data=f"no_game_reason_1_{match_id}")],
-                [InlineKeyboardButton("Match was unresponsive/unwilling to play", callback_data=f"no_game_reason_2_{match_id}")],
-                [InlineKeyboardButton("Uncomfortable with other player", callback_data=f"no_game_reason_3_{match_id}")],
-                [InlineKeyboardButton("Decided not to play", callback_data=f"no_game_reason_4_{match_id}")],
-                [InlineKeyboardButton("Others", callback_data=f"no_game_reason_5_{match_id}")]
-            ]
-            no_game_reasons_markup = InlineKeyboardMarkup(no_game_reasons_keyboard)
-            await context.bot.send_message(
+            outbox.send_message(
                 chat_id=user_telegram_id,
                 text="Sorry to hear that! Why wasn’t a game played?",
-                reply_markup=no_game_reasons_markup
+                reply_markup=feedback_markup(callback_tokens.NO_GAME_REASON, token.match_id, token.role, token.partner_id, user_telegram_id, NO_GAME_REASON_OPTIONS)
             )
 
-    except Exception as e:
+    except Exception:
         # Log the error and notify the user
-        print(f"Error in feedback_response: {e}")
+        logger.exception("Error in feedback_response")
         await query.edit_message_text("An error occurred while processing your feedback. Please try again.")
 
 # Callback function for bot experience rating
@@ -589,60 +793,29 @@ async def bot_experience_response(update: Update, context: ContextTypes.DEFAULT_
     await query.answer()  # Acknowledge the callback query
 
     try:
-        # Extract the rating and match ID from the callback data
-        rating, match_id = query.data.split("_")[2], query.data.split("_")[3]
-        user_telegram_id = query.from_user.id
-
-        # Convert match_id to ObjectId
-        match_id = ObjectId(match_id)
-
-        # Find the match document
-        match_document = matches_collection.find_one({"_id": match_id})
-
-        if not match_document:
-            await query.edit_message_text("Match not found.")
-            return
-
-        # Determine which user (A or B) provided the feedback
-        if user_telegram_id == match_document["userAId"]:
-            field_to_update = "botExperienceA"
-        elif user_telegram_id == match_document["userBId"]:
-            field_to_update = "botExperienceB"
-        else:
-            await query.edit_message_text("You are not part of this match.")
+        token = await read_feedback_token(query, callback_tokens.BOT_EXPERIENCE)
+        if token is None:
             return
+        rating = token.answer
+        user_telegram_id = query.from_user.id
 
         # Update the match document with the bot experience rating
-        matches_collection.update_one(
-            {"_id": match_id},
-            {"$set": {field_to_update: rating}}
-        )
+        await write_buffer.set_fields(matches_collection, {"_id": token.match_id}, {f"botExperience{token.role}": rating})
 
         # Notify the user that their feedback has been recorded
         await query.edit_message_text(f"How was your experience using SportsFinder’s bot? You responded: ⭐ {rating}.")
 
         # Ask about the experience with the matched user
-        other_user_id = match_document["userBId"] if user_telegram_id == match_document["userAId"] else match_document["userAId"]
-        other_user = users_collection.find_one({"telegramId": other_user_id})
-        other_user_display_name = other_user.get("displayName", "Unknown")
-
-        user_experience_keyboard = [
-            [InlineKeyboardButton("⭐ 1", callback_data=f"user_experience_1_{match_id}")],
-            [InlineKeyboardButton("⭐ 2", callback_data=f"user_experience_2_{match_id}")],
-            [InlineKeyboardButton("⭐ 3", callback_data=f"user_experience_3_{match_id}")],
-            [InlineKeyboardButton("⭐ 4", callback_data=f"user_experience_4_{match_id}")],
-            [InlineKeyboardButton("⭐ 5", callback_data=f"user_experience_5_{match_id}")]
-        ]
-        user_experience_markup = InlineKeyboardMarkup(user_experience_keyboard)
-        await context.bot.send_message(
+        other_user_display_name = await get_display_name(token.partner_id)
+        outbox.send_message(
             chat_id=user_telegram_id,
             text=f"How was your experience with {other_user_display_name}?",
-            reply_markup=user_experience_markup
+            reply_markup=feedback_markup(callback_tokens.USER_EXPERIENCE, token.match_id, token.role, token.partner_id, user_telegram_id, RATING_OPTIONS)
         )
 
-    except Exception as e:
+    except Exception:
         # Log the error and notify the user
-        print(f"Error in bot_experience_response: {e}")
+        logger.exception("Error in bot_experience_response")
         await query.edit_message_text("An error occurred while processing your feedback. Please try again.")
 
 # Callback function for user experience rating
@@ -651,54 +824,28 @@ async def user_experience_response(update: Update, context: ContextTypes.DEFAULT
     await query.answer()  # Acknowledge the callback query
 
     try:
-        # Extract the rating and match ID from the callback data
-        rating, match_id = query.data.split("_")[2], query.data.split("_")[3]
-        user_telegram_id = query.from_user.id
-
-        # Convert match_id to ObjectId
-        match_id = ObjectId(match_id)
-
-        # Find the match document
-        match_document = matches_collection.find_one({"_id": match_id})
-
-        if not match_document:
-            await query.edit_message_text("Match not found.")
-            return
-
-        # Determine which user (A or B) provided the feedback
-        if user_telegram_id == match_document["userAId"]:
-            field_to_update = "userExperienceA"
-        elif user_telegram_id == match_document["userBId"]:
-            field_to_update = "userExperienceB"
-        else:
-            await query.edit_message_text("You are not part of this match.")
+        token = await read_feedback_token(query, callback_tokens.USER_EXPERIENCE)
+        if token is None:
             return
-    
+        rating = token.answer
+        user_telegram_id = query.from_user.id
 
         # Update the match document with the user experience rating
-        matches_collection.update_one(
-            {"_id": match_id},
-            {"$set": {field_to_update: rating}}
-        )
-
-        # the other user
-        other_user_id = match_document["userBId"] if user_telegram_id == match_document["userAId"] else match_document["userAId"]
-        other_user = users_collection.find_one({"telegramId": other_user_id})
-        other_user_display_name = other_user.get("displayName", "Unknown")
+        await write_buffer.set_fields(matches_collection, {"_id": token.match_id}, {f"userExperience{token.role}": rating})
 
         # Notify the user that their feedback has been recorded
+        other_user_display_name = await get_display_name(token.partner_id)
         await query.edit_message_text(f"How was your experience with {other_user_display_name}? You responded: ⭐ {rating}.")
 
         # Send a final thank you message
-        await context.bot.send_message(
+        outbox.send_message(
             chat_id=user_telegram_id,
             text="Thank you for your feedback!"
         )
 
-
-    except Exception as e:
+    except Exception:
         # Log the error and notify the user
-        print(f"Error in user_experience_response: {e}")
+        logger.exception("Error in user_experience_response")
         await query.edit_message_text("An error occurred while processing your feedback. Please try again.")
 
 # Callback function for no game reasons
@@ -707,60 +854,28 @@ async def no_game_reason_response(update: Update, context: ContextTypes.DEFAULT_
     await query.answer()  # Acknowledge the callback query
 
     try:
-        # Extract the reason and match ID from the callback data
-        callback_data = query.data
-        parts = callback_data.split("_", 4)  # Split into 5 parts only
-        
-        if len(parts) != 5:
-            await query.edit_message_text("Invalid callback data format.")
+        token = await read_feedback_token(query, callback_tokens.NO_GAME_REASON)
+        if token is None:
             return
-
-        reason, match_id = parts[3], parts[4]
+        reason = token.answer
         user_telegram_id = query.from_user.id
-
-        # Convert match_id to ObjectId
-        try:
-            match_id = ObjectId(match_id)
-        except Exception as e:
-            await query.edit_message_text("Invalid match ID.")
-            return
-
-        # Find the match document
-        match_document = matches_collection.find_one({"_id": match_id})
-
-        if not match_document:
-            await query.edit_message_text("Match not found.")
-            return
-
-        # Determine which user (A or B) provided the feedback
-        if user_telegram_id == match_document["userAId"]:
-            field_to_update = "noGameReasonA"
-        elif user_telegram_id == match_document["userBId"]:
-            field_to_update = "noGameReasonB"
-        else:
-            await query.edit_message_text("You are not part of this match.")
-            return
-        
         reason_text = NO_GAME_REASONS.get(reason, "Unknown reason")
 
         # Update the match document with the reason
-        matches_collection.update_one(
-            {"_id": match_id},
-            {"$set": {field_to_update: reason}}
-        )
+        await write_buffer.set_fields(matches_collection, {"_id": token.match_id}, {f"noGameReason{token.role}": reason})
 
         # Notify the user that their feedback has been recorded
         await query.edit_message_text(f"Why wasn’t a game played? You responded: {reason_text}.")
 
         # Send a final thank you message
-        await context.bot.send_message(
+        outbox.send_message(
             chat_id=user_telegram_id,
             text="Thank you for your feedback!"
         )
 
-    except Exception as e:
+    except Exception:
         # Log the error and notify the user
-        print(f"Error in no_game_reason_response: {e}")
+        logger.exception("Error in no_game_reason_response")
         await query.edit_message_text("An error occurred while processing your feedback. Please try again.")
 
 
@@ -771,30 +886,145 @@ def is_profile_complete(user):
     required_fields = ["age", "gender", "sports"]
     return all(user.get(field) for field in required_fields)
 
+async def create_match(user_a, user_b):
+    """Create an active match between two waiting-pool entries.
+
+    Returns None on success, or the telegramId of a user that was no longer available (user_a's if neither was).
+    Takes two round trips: claiming both users, then inserting the match.
+    """
+    sport = user_a.sport
+    user_a_id, user_b_id = user_a.telegram_id, user_b.telegram_id
+
+    # Atomically claim both users before creating the match
+    # so two searchers tapping at the same moment can never pick the same candidate
+    match_id = ObjectId()
+    unavailable = await claim_pair(user_a_id, user_b_id, sport, match_id)
+    if unavailable:
+        await resync_waiting_pool(unavailable)
+        return user_a_id if user_a_id in unavailable else unavailable[0]
+
+    # Create a match entry using pymongo, including usernames for both users
+    match_document = {
+        "_id": match_id,
+        "userAId": user_a_id,
+        "userBId": user_b_id,
+        "userAUsername": user_a.username,
+        "userBUsername": user_b.username,
+        "sport": sport,
+        "status": "active"
+    }
+    try:
+        await matches_collection.insert_one(match_document)
+    except Exception:
+        # Put both users back into the search if the match could not be stored
+        await release_claims(match_id, sport, (user_a_id, user_b_id))
+        raise
+    waiting_pool.remove(user_a_id)
+    waiting_pool.remove(user_b_id)
+    # Only this worker's own users are cached, the other worker reads its user's route from MongoDB
+    for user, partner in ((user_a, user_b), (user_b, user_a)):
+        if owns_user(user.telegram_id):
+            routing_table.set(user.telegram_id, partner.telegram_id, user.display_name, match_id)
+            display_names.set(user.telegram_id, user.display_name)
+    forget_in_other_shards(user_a_id, user_b_id)
+    return None
+
+# Tell both users who they have been matched with
+def send_match_notifications(user_a, user_b):
+    for recipient, partner in ((user_a, user_b), (user_b, user_a)):
+        outbox.send_message(
+            chat_id=recipient.telegram_id,
+            text=f"You have been matched with {partner.display_name} ({partner.age}, {partner.gender}) for {partner.sport}! 🎉\nYou can now start chatting via this bot, type your messages below!"
+        )
+
+# Scheduled job: match everyone already waiting against each other, not just the latest searcher
+async def run_batch_matcher(context: ContextTypes.DEFAULT_TYPE):
+    pool = waiting_pool
+    if SHARD_COUNT > 1:
+        # Users of every worker process wait in MongoDB: pair them from a snapshot, this worker's pool keeps only its own users
+        pool = WaitingPool()
+        await load_waiting_users(pool, all_shards=True)
+
+    created = 0
+    for sport in list(pool.sports):
+        for user_a, user_b in plan_matches(pool, sport):
+            # Entries can go stale while earlier matches are created, the claims catch that
+            if await create_match(user_a, user_b) is None:
+                # Queued right away, the outbox sends to all chats in parallel
+                send_match_notifications(user_a, user_b)
+                created += 1
+
+    if created:
+        matching_logger.info("Batch matcher created %d matches", created)
+
+# Find mutually compatible waiting users in MongoDB, for when the in-memory pool is not used
+async def find_candidates_in_db(searcher):
+    # The searcher's own preferences are checked by MongoDB, only plausible candidates come back
+    pipeline = build_candidate_pipeline(searcher.telegram_id, searcher.sport, searcher.preferences)
+    if pipeline is None:
+        return []
+
+    candidates = []
+    for seq, potential_match in enumerate(await users_collection.aggregate(pipeline)):
+        candidate = PoolEntry(potential_match, searcher.sport, seq, preference_cache.get_sport(potential_match, searcher.sport))
+        # Users with string ages or JSON preferences are only filtered here
+        if searcher.matches(candidate):
+            candidates.append(candidate)
+        elif candidate_trace.sampled():
+            matching_logger.debug("Rejected candidate %s for %s in %s", candidate.telegram_id, searcher.telegram_id, searcher.sport)
+    return candidates
+
+# Claim both users of a match in one round trip, only users still waiting for this sport can be claimed
+async def claim_pair(user_a_id, user_b_id, sport, match_id):
+    """Claim two users for a match. Returns the ids of the users that could not be claimed, empty on success."""
+    result = await users_collection.update_many(
+        {"telegramId": {"$in": [user_a_id, user_b_id]}, "wantToBeMatched": True, "selectedSport": sport, "isMatched": {"$ne": True}},
+        {"$set": {"isMatched": True, "wantToBeMatched": False, "activeMatchId": match_id}},
+    )
+    if result.modified_count == 2:
+        return []
+    if result.modified_count == 0:
+        return [user_a_id, user_b_id]
+
+    # Only one of them was still available: put them back, which also tells which one it was
+    released = await users_collection.find_one_and_update(
+        {"activeMatchId": match_id},
+        {"$set": {"isMatched": False, "wantToBeMatched": True, "selectedSport": sport}, "$unset": {"activeMatchId": ""}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if released is None:
+        return [user_a_id, user_b_id]
+    # A concurrent claim may have taken them out of the pool while they were claimed here
+    sync_waiting_pool(released["telegramId"], released)
+    return [user_b_id if released["telegramId"] == user_a_id else user_a_id]
+
+# Undo the claims made for a match that was never created, the users go back to searching
+async def release_claims(match_id, sport, telegram_ids):
+    await users_collection.update_many(
+        {"activeMatchId": match_id},
+        {"$set": {"isMatched": False, "wantToBeMatched": True, "selectedSport": sport}, "$unset": {"activeMatchId": ""}}
+    )
+    await resync_waiting_pool(telegram_ids)
+
 async def are_preferences_complete(update: Update, user):
     """Check if the user's match preferences include all their sports."""
     
     # Extract user's sports and matchPreferences (ensuring matchPreferences is always a dictionary)
     sports = user.get("sports", [])  # Ensure we have a list of sports
-    print("all sports user selected: ", sports, type(sports))
+    logger.debug("Sports of %s: %r", user.get("telegramId"), sports)
     
-    # Retrieve the current user's match preferences for the selected sport
-    match_preferences = user.get("matchPreferences", {})
-
-    # Convert from string to dictionary 
-    if isinstance(match_preferences, str):
-        try:
-            match_preferences = json.loads(match_preferences)  # Convert JSON string to dictionary
-        except json.JSONDecodeError:
-            print("Error: matchPreference is not a valid JSON format.")
-            await update.message.reply_text("Your match preferences are not in a valid format. Please update them.")
-            return False  # Return False if the JSON is invalid
+    # Retrieve the current user's compiled match preferences
+    match_preferences = preference_cache.get(user)
+    if match_preferences is None:
+        logger.info("matchPreferences of %s is not valid JSON", user.get("telegramId"))
+        await update.message.reply_text("Your match preferences are not in a valid format. Please update them.")
+        return False  # Return False if the JSON is invalid
 
-    print("match preferences of the user", match_preferences, type(match_preferences))
+    logger.debug("Match preferences of %s: %r", user.get("telegramId"), match_preferences)
 
     # Find sports that are missing from matchPreferences
     missing_sports = [sport for sport in sports if sport not in match_preferences]
-    print("missing sports: ", missing_sports)
+    logger.debug("Sports without match preferences for %s: %s", user.get("telegramId"), missing_sports)
 
     # If there are missing sports, inform the user to complete their preferences
     if missing_sports:
@@ -814,7 +1044,7 @@ FEEDBACK = 1
 # Command handler for /feedback
 async def feedback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_telegram_id = int(update.message.from_user.id)  # Ensure it's an integer
-    user = users_collection.find_one({"telegramId": user_telegram_id})
+    user = await users_collection.find_one({"telegramId": user_telegram_id})
 
     # Check if the user is in a match
     if user.get("isMatched", False):
@@ -823,7 +1053,7 @@ async def feedback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return  # Do not start the feedback conversation
     
-    print("/feedback command triggered")  # Debugging print
+    logger.debug("/feedback from %s", user_telegram_id)
     await update.message.reply_text("Provide any feedback/ reports here! Every response is greatly appreciated and every single one of them will be read! Type below:")
     context.user_data["feedback_state"] = FEEDBACK  # Debugging: Track state in user_data
     return FEEDBACK  # Move to the FEEDBACK state
@@ -833,13 +1063,12 @@ async def receive_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_username = update.message.from_user.username or "Unknown"
 
     """Receive the user's feedback and acknowledge it."""
-    print("User sent feedback")  # Debugging print
-    print(f"Current state: {context.user_data.get('feedback_state')}")  # Debugging print
+    logger.debug("Feedback received, conversation state %s", context.user_data.get("feedback_state"))
     user_feedback = update.message.text  # Get the user's message
     user_telegram_id = update.message.from_user.id
 
-    # Save the feedback to MongoDB
-    feedback_collection.insert_one({
+    # Queue the feedback, it is stored with the next bulk insert
+    await write_buffer.insert_one(feedback_collection, {
         "telegramId": user_telegram_id,
         "username": user_username,
         "feedback": user_feedback,
@@ -853,11 +1082,15 @@ async def receive_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Fallback handler to cancel the conversation
 async def cancel_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the feedback conversation."""
-    print("Feedback process cancelled")  # Debugging print
+    logger.debug("Feedback cancelled")
     await update.message.reply_text("Feedback process cancelled.")
     return ConversationHandler.END
 
+# Sampled cProfile runs and slow-update breakdowns, switched with PROFILE_UPDATES or /profiling (see profiling.py)
+profiler = HandlerProfiler(directory=PROFILE_DIR, every=PROFILE_EVERY, slow_seconds=PROFILE_SLOW_MS / 1000, enabled=PROFILE_UPDATES)
+
 # Define the setup_handlers function
+# Registers every handler, so tools like benchmark.py can set up their own Application the same way
 def setup_handlers(application):
     # Feedback conversation handler
     feedback_conv_handler = ConversationHandler(
@@ -871,42 +1104,73 @@ def setup_handlers(application):
     # Add the feedback conversation handler to the application
     application.add_handler(feedback_conv_handler)
 
-# Call the setup_handlers function to add the feedback conversation handler
-setup_handlers(application)
+    # Register the /start, /matchme, /endmatch command handlers and the message handler for forwarding messages
+    start_handler = CommandHandler('start', start)
+    application.add_handler(start_handler)
 
-# Register the /start, /matchme, /endmatch command handlers and the message handler for forwarding messages
-start_handler = CommandHandler('start', start)
-application.add_handler(start_handler)
+    editprofile_handler = CommandHandler('profile', edit_profile)
+    application.add_handler(editprofile_handler)
 
-editprofile_handler = CommandHandler('profile', edit_profile)
-application.add_handler(editprofile_handler)
+    matchpreferences_handler = CommandHandler('matchpreferences', match_preferences)
+    application.add_handler(matchpreferences_handler)
 
-matchpreferences_handler = CommandHandler('matchpreferences', match_preferences)
-application.add_handler(matchpreferences_handler)
+    matchme_handler = CommandHandler('matchme', match_me)
+    application.add_handler(matchme_handler)
 
-matchme_handler = CommandHandler('matchme', match_me)
-application.add_handler(matchme_handler)
+    endmatch_handler = CommandHandler('endmatch', end_match)
+    application.add_handler(endmatch_handler)
 
-endmatch_handler = CommandHandler('endmatch', end_match)
-application.add_handler(endmatch_handler)
+    message_handler = MessageHandler(filters.UpdateType.MESSAGE & ~filters.COMMAND & ~filters.StatusUpdate.ALL, forward_message)
+    application.add_handler(message_handler)
 
-message_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, forward_message)
-application.add_handler(message_handler)
+    # Register the callback query handler for sport selection
+    application.add_handler(CallbackQueryHandler(sport_selected, pattern="^sport_"))
 
-# Register the callback query handler for sport selection
-application.add_handler(CallbackQueryHandler(sport_selected, pattern="^sport_"))
+    # Register the callback query handler for feedback responses
+    application.add_handler(CallbackQueryHandler(feedback_response, pattern=f"^(feedback_|{callback_tokens.GAME_PLAYED}\\.)"))
 
-# Register the callback query handler for feedback responses
-application.add_handler(CallbackQueryHandler(feedback_response, pattern="^feedback_"))
+    # Register the callback query handlers for follow-up questions
+    application.add_handler(CallbackQueryHandler(bot_experience_response, pattern=f"^(bot_experience_|{callback_tokens.BOT_EXPERIENCE}\\.)"))
+    application.add_handler(CallbackQueryHandler(user_experience_response, pattern=f"^(user_experience_|{callback_tokens.USER_EXPERIENCE}\\.)"))
+    application.add_handler(CallbackQueryHandler(no_game_reason_response, pattern=f"^(no_game_reason_|{callback_tokens.NO_GAME_REASON}\\.)"))
 
-# Register the callback query handlers for follow-up questions
-application.add_handler(CallbackQueryHandler(bot_experience_response, pattern="^bot_experience_"))
-application.add_handler(CallbackQueryHandler(user_experience_response, pattern="^user_experience_"))
-application.add_handler(CallbackQueryHandler(no_game_reason_response, pattern="^no_game_reason_"))
+    # Admin broadcasts and profiling
+    application.add_handler(CommandHandler('broadcast', broadcast_command))
+    application.add_handler(CommandHandler('profiling', profiling_command))
 
-#/endsearch
-application.add_handler(CommandHandler('endsearch', end_search))
-application.add_handler(CallbackQueryHandler(end_search_callback, pattern="^endsearch_"))
+    #/endsearch
+    application.add_handler(CommandHandler('endsearch', end_search))
+    application.add_handler(CallbackQueryHandler(end_search_callback, pattern="^endsearch_"))
+
+    # Time (and maybe profile) every handler on its own; the user's lane is LaneApplication's, around the whole update
+    wrap_handler_callbacks(application, time_handler)
+    wrap_handler_callbacks(application, profiler.wrap)
+
+# Call the setup_handlers function to add all the handlers
+setup_handlers(application)
+
+# Record incoming updates for replay.py, in a group that runs before every handler
+update_recorder = None
+if UPDATE_LOG_PATH:
+    update_recorder = UpdateRecorder(
+        UPDATE_LOG_PATH, max_bytes=UPDATE_LOG_MAX_BYTES, backups=UPDATE_LOG_BACKUPS,
+        anonymize_key=callback_secret if UPDATE_LOG_ANONYMIZE else None,
+    )
+    application.add_handler(TypeHandler(Update, update_recorder.record), group=-100)
 
 # Start the bot
-application.run_polling()
\ No newline at end of file
+if __name__ == "__main__":
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("WEBHOOK_URL must be set when BOT_MODE=webhook")
+        # Telegram pushes updates to the built-in HTTP listener instead of being long-polled
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling()
\ No newline at end of file
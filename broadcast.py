@@ -0,0 +1,160 @@
+"""Admin broadcasts to every user, sent at a bounded rate and resumable after a restart.
+
+Every broadcast is a document in the Broadcast collection. Recipients are read a page at a time in
+telegramId order (keyset pagination on the unique telegramId index, projecting nothing else), each page is
+sent through the outbox and awaited, and only then is the page's last telegramId checkpointed. After a crash
+or redeploy the broadcast carries on after its checkpoint, so at most one page is sent twice. With
+several worker processes (sharding.py) a broadcast is resumed by the worker that started it.
+"""
+from pymongo.errors import PyMongoError
+from outbox import TokenBucket
+import asyncio
+import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+RUNNING = "running"
+DONE = "done"
+
+
+def progress_text(broadcast):
+    handled = broadcast["sent"] + broadcast["failed"]
+    state = "finished" if broadcast["status"] == DONE else "in progress"
+    return (
+        f"Broadcast {state}: {handled} of {broadcast['total']} users handled, "
+        f"{broadcast['sent']} sent, {broadcast['failed']} failed."
+    )
+
+
+class Broadcaster:
+    """Sends broadcasts in the background, `page_size` messages in flight at most and `rate` messages a second.
+
+    The rate stays below the outbox's global rate so the bot's regular messages still get through.
+    """
+
+    def __init__(self, database, outbox, rate=20, page_size=100, progress_interval=5.0, shard=0):
+        self.users = database.collection("User")
+        self.broadcasts = database.collection("Broadcast")
+        self.outbox = outbox
+        self.bucket = TokenBucket(rate, 1)
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.shard = shard  # Worker process whose broadcasts this sends and resumes
+        self._tasks = {}  # broadcast _id -> asyncio.Task
+
+    async def start(self, text, admin_id):
+        """Create a broadcast of `text` to every user and start sending it. Progress goes to the admin's chat."""
+        try:
+            progress_message = await self.outbox.send_message(admin_id, "Broadcast starting...")
+            progress_message_id = progress_message.message_id
+        except Exception:
+            progress_message_id = None  # Only the final report is sent then
+        now = datetime.datetime.utcnow()
+        broadcast = {
+            "text": text,
+            "adminId": admin_id,
+            "progressMessageId": progress_message_id,
+            "status": RUNNING,
+            "shard": self.shard,
+            # Walks the telegramId index instead of the whole collection
+            "total": await self.users.count_documents({}, hint=[("telegramId", 1)]),
+            "lastTelegramId": None,  # Checkpoint: everyone up to this telegramId has been handled
+            "sent": 0,
+            "failed": 0,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        await self.broadcasts.insert_one(broadcast)
+        logger.info("Broadcast %s started by %s for %d users", broadcast["_id"], admin_id, broadcast["total"])
+        self._spawn(broadcast)
+        return broadcast
+
+    async def resume(self):
+        """Restart the broadcasts a previous run of this worker left unfinished."""
+        # Broadcasts from before sharding have no shard, worker 0 resumes them
+        shards = [self.shard, None] if self.shard == 0 else [self.shard]
+        for broadcast in await self.broadcasts.find({"status": RUNNING, "shard": {"$in": shards}}):
+            if broadcast["_id"] not in self._tasks:
+                logger.info("Resuming broadcast %s after telegramId %s", broadcast["_id"], broadcast["lastTelegramId"])
+                self._spawn(broadcast)
+
+    async def stop(self):
+        """Cancel the running broadcasts, they resume from their checkpoint on the next start."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, broadcast):
+        task = asyncio.create_task(self._run(broadcast))
+        self._tasks[broadcast["_id"]] = task
+
+        def finished(task):
+            self._tasks.pop(broadcast["_id"], None)
+            if not task.cancelled() and task.exception() is not None:
+                logger.error("Broadcast %s stopped, it resumes on the next start", broadcast["_id"], exc_info=task.exception())
+
+        task.add_done_callback(finished)
+
+    async def _run(self, broadcast):
+        reported_at = time.monotonic()
+        reported_text = None
+        while True:
+            try:
+                if not await self._send_page(broadcast):
+                    break
+            except PyMongoError as e:
+                logger.warning("Broadcast %s could not read or checkpoint a page, retrying: %s", broadcast["_id"], e)
+                await asyncio.sleep(5)
+                continue
+            if time.monotonic() - reported_at >= self.progress_interval:
+                reported_at = time.monotonic()
+                reported_text = self._report(broadcast, reported_text)
+
+        broadcast["status"] = DONE
+        await self.broadcasts.update_one({"_id": broadcast["_id"]}, {"$set": {"status": DONE, "updatedAt": datetime.datetime.utcnow()}})
+        logger.info("Broadcast %s finished: %d sent, %d failed", broadcast["_id"], broadcast["sent"], broadcast["failed"])
+        self._report(broadcast, reported_text)
+        if broadcast["progressMessageId"] is None:
+            self.outbox.send_message(broadcast["adminId"], progress_text(broadcast))
+
+    async def _send_page(self, broadcast):
+        """Send the page after the checkpoint and move the checkpoint past it. Returns False once nobody is left."""
+        last = broadcast["lastTelegramId"]
+        page = await self.users.find(
+            {"telegramId": {"$gt": last}} if last is not None else {},
+            {"_id": 0, "telegramId": 1},
+            sort=[("telegramId", 1)],
+            limit=self.page_size,
+        )
+        if not page:
+            return False
+
+        sends = []
+        for user in page:
+            await self.bucket.acquire()
+            sends.append(self.outbox.send_message(user["telegramId"], broadcast["text"]))
+        # A blocked bot, a deleted account or a full outbox all count as failed, they are not retried
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        failed = sum(1 for result in results if isinstance(result, Exception))
+
+        checkpoint = {
+            "lastTelegramId": page[-1]["telegramId"],
+            "sent": broadcast["sent"] + len(results) - failed,
+            "failed": broadcast["failed"] + failed,
+        }
+        await self.broadcasts.update_one({"_id": broadcast["_id"]}, {"$set": {**checkpoint, "updatedAt": datetime.datetime.utcnow()}})
+        broadcast.update(checkpoint)
+        return True
+
+    def _report(self, broadcast, reported_text):
+        """Edit the admin's progress message, unless it would not change. Returns the text shown."""
+        text = progress_text(broadcast)
+        if broadcast["progressMessageId"] is not None and text != reported_text:
+            self.outbox.submit(
+                broadcast["adminId"], "edit_message_text",
+                chat_id=broadcast["adminId"], message_id=broadcast["progressMessageId"], text=text,
+            )
+        return text
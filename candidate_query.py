@@ -0,0 +1,57 @@
+from preferences import ANY_GENDER
+
+
+def build_candidate_filter(telegram_id, sport, preferences):
+    """Server-side version of the searcher's one-sided checks, or None if nobody can match.
+
+    Users whose matchPreferences or age are still stored as strings cannot be filtered on those
+    fields, so they are let through and checked in Python like before.
+    """
+    if not preferences.locations:
+        return None  # A common location is always required
+
+    low, high = preferences.age_range
+    conditions = [
+        {"$or": [{"age": {"$gte": low, "$lte": high}}, {"age": {"$type": "string"}}]},
+        {"$or": [
+            {"matchPreferences": {"$type": "string"}},
+            {f"matchPreferences.{sport}.locationPreferences": {"$in": sorted(preferences.locations)}},
+        ]},
+    ]
+    query = {
+        "wantToBeMatched": True,
+        "selectedSport": sport,
+        "telegramId": {"$ne": telegram_id},
+        "$and": conditions,
+    }
+    if preferences.gender_preference not in ANY_GENDER:
+        query["gender"] = preferences.gender_preference
+    if preferences.skill_levels:
+        query[f"sports.{sport}"] = {"$in": sorted(preferences.skill_levels)}
+    return query
+
+
+def build_candidate_pipeline(telegram_id, sport, preferences):
+    """Aggregation pipeline returning plausible candidates with only the fields the match check needs."""
+    query = build_candidate_filter(telegram_id, sport, preferences)
+    if query is None:
+        return None
+    return [
+        {"$match": query},
+        {"$project": {
+            "_id": 0,
+            "telegramId": 1,
+            "username": 1,
+            "displayName": 1,
+            "age": 1,
+            "gender": 1,
+            f"sports.{sport}": 1,
+            "updatedAt": 1,  # Version of the preferences, so the preference cache recompiles only after a change
+            # Only this sport's preferences, unless they are still a JSON string
+            "matchPreferences": {"$cond": [
+                {"$eq": [{"$type": "$matchPreferences"}, "string"]},
+                "$matchPreferences",
+                {sport: f"$matchPreferences.{sport}"},
+            ]},
+        }},
+    ]
@@ -0,0 +1,109 @@
+"""Check that an anonymized update log record keeps no real user, chat or match id anywhere.
+
+Builds a feedback button tap, as the bot records it (the tapped token in callback_query.data, the
+keyboard it came from in the message's reply_markup, plus a button in the pre-token format), anonymizes
+it like UpdateRecorder does and looks for the real ids in the JSON line, including inside the base64
+payload of every feedback token left in it.
+
+Usage: python check_update_log.py
+"""
+import base64
+import binascii
+import json
+import sys
+
+from bson import ObjectId
+
+import callback_tokens
+from callback_tokens import FeedbackToken
+from update_log import anonymize
+
+KEY = b"anonymization key"
+SIGNING_KEY = b"production callback secret"
+USER_ID = 123456789
+PARTNER_ID = 987654321
+MATCH_ID = ObjectId("65f1a2b3c4d5e6f708192a3b")
+
+
+def feedback_tap():
+    buttons = [
+        callback_tokens.encode(SIGNING_KEY, FeedbackToken(callback_tokens.GAME_PLAYED, MATCH_ID, "A", PARTNER_ID, answer), USER_ID)
+        for answer in callback_tokens.ANSWERS[callback_tokens.GAME_PLAYED]
+    ]
+    user = {"id": USER_ID, "is_bot": False, "first_name": "Alice", "username": "alice"}
+    return {
+        "update_id": 1,
+        "callback_query": {
+            "id": "1",
+            "from": user,
+            "chat_instance": "1",
+            "data": buttons[0],
+            "message": {
+                "message_id": 2,
+                "date": 0,
+                "chat": {"id": USER_ID, "type": "private", "first_name": "Alice"},
+                "from": {"id": 1, "is_bot": True, "first_name": "SportsFinder"},
+                "text": "Did you play with Bob?",
+                "reply_markup": {"inline_keyboard": [
+                    [{"text": answer, "callback_data": data} for answer, data in zip(("Yes", "No"), buttons)],
+                    [{"text": "Old button", "callback_data": f"feedback_yes_{MATCH_ID}"}],
+                ]},
+            },
+        },
+    }
+
+
+def token_ids(value):
+    """(match id, partner id) inside a string shaped like a feedback token, or None."""
+    kind, separator, data = value.partition(".")
+    if not separator or kind not in callback_tokens.ANSWERS:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) != callback_tokens.PAYLOAD.size + callback_tokens.MAC_SIZE:
+        return None
+    match_id, role, partner_id, answer = callback_tokens.PAYLOAD.unpack(raw[:callback_tokens.PAYLOAD.size])
+    return ObjectId(match_id), partner_id
+
+
+def strings(data):
+    if isinstance(data, dict):
+        for value in data.values():
+            yield from strings(value)
+    elif isinstance(data, list):
+        for value in data:
+            yield from strings(value)
+    elif isinstance(data, str):
+        yield data
+
+
+def main():
+    original = feedback_tap()
+    assert token_ids(original["callback_query"]["data"]) == (MATCH_ID, PARTNER_ID)
+    anonymized = anonymize(original, KEY)
+    line = json.dumps(anonymized)
+
+    problems = []
+    for real in (str(USER_ID), str(PARTNER_ID), str(MATCH_ID), "Alice", "alice", "Bob"):
+        if real in line:
+            problems.append(f"{real} appears in the record")
+    tokens = [ids for ids in map(token_ids, strings(anonymized)) if ids is not None]
+    if len(tokens) != 3:
+        problems.append(f"expected 3 feedback tokens in the record, found {len(tokens)}")
+    for match_id, partner_id in tokens:
+        if match_id == MATCH_ID or partner_id in (USER_ID, PARTNER_ID):
+            problems.append(f"a feedback token still holds a real id: match {match_id}, partner {partner_id}")
+    if len({ids for ids in tokens}) != 1:
+        problems.append("the buttons of one match got different pseudonyms")
+
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    if not problems:
+        print(f"OK: no real id in the anonymized record ({len(line)} bytes, {len(tokens)} feedback tokens rewritten)")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor
+from metrics import MONGO_SECONDS, query_shape
+from profiling import record_mongo
+import asyncio
+import contextvars
+import functools
+import time
+
+# Set to a collections.Counter to count the operations (i.e. round trips) a piece of code issues,
+# per operation name. benchmark.py uses it to check the round trips of every update.
+round_trips = contextvars.ContextVar("round_trips", default=None)
+
+
+# pymongo is synchronous, so every call is run on a bounded thread pool instead of the event loop.
+# The pool has one thread per pooled connection, so a thread never waits on the driver for a socket.
+class AsyncDatabase:
+    def __init__(self, url, name, pool_size=20, timeout_ms=10000):
+        # timeoutMS bounds server selection, connection checkout and the operation itself
+        self.client = MongoClient(url, maxPoolSize=pool_size, timeoutMS=timeout_ms)
+        self.db = self.client[name]
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="mongo")
+        self.collections = {}
+
+    def collection(self, name):
+        if name not in self.collections:
+            self.collections[name] = AsyncCollection(self.db[name], self.executor)
+        return self.collections[name]
+
+    def use(self, db):
+        """Point every collection wrapper at another database object (e.g. an in-memory one for offline tools)."""
+        self.db = db
+        for name, wrapper in self.collections.items():
+            wrapper.collection = db[name]
+
+    async def run(self, func, *args, **kwargs):
+        """Run any blocking database work on the database thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+
+class AsyncCollection:
+    """Awaitable wrapper around a pymongo collection."""
+
+    def __init__(self, collection, executor):
+        self.collection = collection
+        self.name = collection.name
+        self.executor = executor
+
+    async def _run(self, operation, query, func, *args, **kwargs):
+        counter = round_trips.get()
+        if counter is not None:
+            counter[operation] += 1
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+            outcome = "ok"
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            MONGO_SECONDS.observe(elapsed, collection=self.name, operation=operation, shape=query_shape(query), outcome=outcome)
+            record_mongo(elapsed)
+
+    async def find_one(self, filter=None, *args, **kwargs):
+        return await self._run("find_one", filter, self.collection.find_one, filter, *args, **kwargs)
+
+    async def find(self, filter=None, *args, **kwargs):
+        # The cursor is drained on the worker thread, so getMore calls never touch the event loop
+        return await self._run("find", filter, lambda: list(self.collection.find(filter, *args, **kwargs)))
+
+    async def aggregate(self, pipeline, *args, **kwargs):
+        return await self._run("aggregate", pipeline, lambda: list(self.collection.aggregate(pipeline, *args, **kwargs)))
+
+    async def count_documents(self, filter, *args, **kwargs):
+        return await self._run("count_documents", filter, self.collection.count_documents, filter, *args, **kwargs)
+
+    async def insert_one(self, document, *args, **kwargs):
+        return await self._run("insert_one", None, self.collection.insert_one, document, *args, **kwargs)
+
+    async def insert_many(self, documents, *args, **kwargs):
+        return await self._run("insert_many", None, self.collection.insert_many, documents, *args, **kwargs)
+
+    async def bulk_write(self, requests, *args, **kwargs):
+        return await self._run("bulk_write", None, self.collection.bulk_write, requests, *args, **kwargs)
+
+    async def update_one(self, filter, *args, **kwargs):
+        return await self._run("update_one", filter, self.collection.update_one, filter, *args, **kwargs)
+
+    async def update_many(self, filter, *args, **kwargs):
+        return await self._run("update_many", filter, self.collection.update_many, filter, *args, **kwargs)
+
+    async def find_one_and_update(self, filter, *args, **kwargs):
+        return await self._run("find_one_and_update", filter, self.collection.find_one_and_update, filter, *args, **kwargs)
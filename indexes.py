@@ -0,0 +1,177 @@
+"""Index bootstrap and query-plan verification for the User, Match and Broadcast collections.
+
+Run `python indexes.py` to create the indexes and explain() every query shape the bot issues.
+It exits with an error if any shape still does a COLLSCAN, or does not use the index it names.
+"""
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import datetime
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Index already exists under another name or with other options (e.g. created by the web apps)
+INDEX_CONFLICT_CODES = (85, 86)
+
+# Indexes for every query shape the bot issues, per collection
+INDEXES = {
+    "User": [
+        ([("telegramId", 1)], {"name": "telegramId_unique", "unique": True}),
+        # Waiting-pool queries: equality on wantToBeMatched/selectedSport, then the telegramId $ne
+        ([("wantToBeMatched", 1), ("selectedSport", 1), ("telegramId", 1)], {"name": "waiting_by_sport"}),
+        ([("activeMatchId", 1)], {"name": "activeMatchId", "sparse": True}),
+        # Polling for profile edits made in the web apps, in (updatedAt, _id) order (user_sync.py)
+        ([("updatedAt", 1), ("_id", 1)], {"name": "updatedAt_id"}),
+    ],
+    "Match": [
+        # The $or in forward_message/end_match uses one index per branch
+        ([("userAId", 1), ("status", 1)], {"name": "userA_status"}),
+        ([("userBId", 1), ("status", 1)], {"name": "userB_status"}),
+        # Active match count of the metrics endpoint
+        ([("status", 1)], {"name": "status"}),
+    ],
+    "Broadcast": [
+        # Unfinished broadcasts, resumed on startup (broadcast.py)
+        ([("status", 1)], {"name": "status"}),
+    ],
+}
+
+# Broadcast recipients are read and counted in telegramId order (broadcast.py)
+RECIPIENT_ORDER = [("telegramId", 1)]
+
+# One example of every query shape the bot issues: (description, collection, filter[, options]). Options are
+# find()'s sort/limit, or count (count_documents), and hint; index is the key pattern the plan must use
+QUERY_SHAPES = [
+    ("user by telegramId", "User", {"telegramId": 1}),
+    ("users by telegramId list", "User", {"telegramId": {"$in": [1, 2]}}),
+    ("waiting candidates for a sport", "User", {"telegramId": {"$ne": 1}, "wantToBeMatched": True, "selectedSport": "Tennis"}),
+    ("filtered candidates for a sport", "User", {
+        "wantToBeMatched": True, "selectedSport": "Tennis", "telegramId": {"$ne": 1}, "gender": "Female",
+        "sports.Tennis": {"$in": ["Beginner"]},
+        "$and": [
+            {"$or": [{"age": {"$gte": 18, "$lte": 30}}, {"age": {"$type": "string"}}]},
+            {"$or": [{"matchPreferences": {"$type": "string"}}, {"matchPreferences.Tennis.locationPreferences": {"$in": ["North"]}}]},
+        ],
+    }),
+    ("waiting pool warm-up", "User", {"wantToBeMatched": True, "isMatched": {"$ne": True}}),
+    ("claim a pair of waiting users", "User", {"telegramId": {"$in": [1, 2]}, "wantToBeMatched": True, "selectedSport": "Tennis", "isMatched": {"$ne": True}}),
+    ("release claimed users", "User", {"activeMatchId": ObjectId()}),
+    ("users changed since the last poll", "User", {"$or": [
+        {"updatedAt": {"$gt": datetime.datetime(2024, 1, 1)}}, {"updatedAt": datetime.datetime(2024, 1, 1), "_id": {"$gt": ObjectId()}},
+    ]}, {"sort": [("updatedAt", 1), ("_id", 1)], "limit": 500}),
+    ("broadcast recipient count", "User", {}, {"count": True, "hint": RECIPIENT_ORDER, "index": dict(RECIPIENT_ORDER)}),
+    ("first page of broadcast recipients", "User", {}, {"sort": RECIPIENT_ORDER, "limit": 100, "index": dict(RECIPIENT_ORDER)}),
+    ("next page of broadcast recipients", "User", {"telegramId": {"$gt": 1}}, {"sort": RECIPIENT_ORDER, "limit": 100, "index": dict(RECIPIENT_ORDER)}),
+    ("active match of a user", "Match", {"$or": [{"userAId": 1}, {"userBId": 1}], "status": "active"}),
+    ("match by id", "Match", {"_id": ObjectId()}),
+    ("active matches", "Match", {"status": "active"}),
+    ("unfinished broadcasts of a worker", "Broadcast", {"status": "running", "shard": {"$in": [0, None]}}),
+]
+
+
+def ensure_indexes(db):
+    """Create the indexes the bot relies on. Safe to run on every start."""
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        for keys, options in indexes:
+            try:
+                collection.create_index(keys, **options)
+            except DuplicateKeyError:
+                # Existing duplicates block the unique index, fall back to a plain one so lookups stay indexed
+                logger.warning("Duplicate values prevent unique index %s on %s, creating a non-unique index", options["name"], collection_name)
+                fallback_options = {key: value for key, value in options.items() if key != "unique"}
+                fallback_options["name"] = options["name"].replace("_unique", "")
+                collection.create_index(keys, **fallback_options)
+            except OperationFailure as e:
+                if e.code not in INDEX_CONFLICT_CODES:
+                    raise
+                logger.info("Index %s on %s already exists in another form, keeping it", options["name"], collection_name)
+
+
+def plan_nodes(plan):
+    """Collect the stages of a (possibly nested) explain() plan, as dicts with a "stage" name."""
+    nodes = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            nodes.append(plan)
+        for key in ("inputStage", "queryPlan", "winningPlan"):
+            nodes.extend(plan_nodes(plan.get(key)))
+        for child in plan.get("inputStages", []):
+            nodes.extend(plan_nodes(child))
+    return nodes
+
+
+def plan_stages(plan):
+    """Collect the stage names of a (possibly nested) explain() plan."""
+    return [node["stage"] for node in plan_nodes(plan)]
+
+
+def winning_plans(explain):
+    """Every winningPlan in an explain() result: one for a find, one per $cursor stage of an aggregation."""
+    if isinstance(explain, list):
+        return [plan for item in explain for plan in winning_plans(item)]
+    if not isinstance(explain, dict):
+        return []
+    if "winningPlan" in explain:
+        return [explain["winningPlan"]]
+    return [plan for value in explain.values() for plan in winning_plans(value)]
+
+
+def explain_shape(db, collection_name, query, options):
+    if options.get("count"):
+        # count_documents is an aggregation: $match, then $group counting the documents
+        pipeline = [{"$match": query}, {"$group": {"_id": 1, "n": {"$sum": 1}}}]
+        command = {"aggregate": collection_name, "pipeline": pipeline, "cursor": {}}
+        if "hint" in options:
+            command["hint"] = dict(options["hint"])
+        return db.command("explain", command)
+    return db[collection_name].find(
+        query, sort=options.get("sort"), limit=options.get("limit", 0), hint=options.get("hint"),
+    ).explain()
+
+
+def check_query_plans(db):
+    """explain() every query shape. Returns a list of (description, stages) for shapes that do a COLLSCAN
+    or do not use the index they name."""
+    collection_scans = []
+    for description, collection_name, query, *options in QUERY_SHAPES:
+        options = options[0] if options else {}
+        nodes = [node for plan in winning_plans(explain_shape(db, collection_name, query, options)) for node in plan_nodes(plan)]
+        stages = [node["stage"] for node in nodes]
+        scanned = "COLLSCAN" in stages
+        if "index" in options and not any(node.get("keyPattern") == options["index"] for node in nodes):
+            scanned = True
+            stages.append(f"(no {options['index']} index)")
+        logger.info("%8s  %s: %s -> %s", "COLLSCAN" if scanned else "ok", collection_name, description, " <- ".join(stages))
+        if scanned:
+            collection_scans.append((description, stages))
+    return collection_scans
+
+
+def verify_query_plans(db):
+    """Fail loudly if any query shape the bot issues is not served by an index."""
+    collection_scans = check_query_plans(db)
+    if collection_scans:
+        shapes = ", ".join(description for description, stages in collection_scans)
+        raise RuntimeError(f"{len(collection_scans)} query shapes still do a COLLSCAN or miss their index: {shapes}")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+    from logging_setup import configure_logging
+
+    load_dotenv()
+    configure_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_LEVELS", ""), os.getenv("LOG_FORMAT", "text"))
+    client = MongoClient(os.getenv("DATABASE_URL"))
+    db = client[os.getenv("DATABASE_NAME", "test_database")]
+
+    if "--no-create" not in sys.argv:
+        ensure_indexes(db)
+    try:
+        verify_query_plans(db)
+    except RuntimeError as e:
+        sys.exit(f"ERROR: {e}")
+    print("All query shapes use an index.")
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+
+from telegram.ext import Application, ConversationHandler
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+LANE_OVERFLOW_UPDATES = Counter(
+    "sportsfinder_user_lane_overflow_updates_total", "Updates queued while their user already had max_pending updates queued",
+)
+
+
+class Lane:
+    __slots__ = ("lock", "pending", "told")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # asyncio.Lock wakes its waiters first-in, first-out
+        self.pending = 0
+        self.told = False  # Whether the user was told to slow down since the lane filled up
+
+
+class UserLanes:
+    """Processes updates strictly one after another per user, while different users run in parallel.
+
+    The whole of Application.process_update runs in the lane (see LaneApplication), so handler selection,
+    including ConversationHandler states, happens in arrival order too, not just the callbacks. PTB starts
+    the tasks for a user's updates in the order they arrived, and each task queues on the user's lane
+    before doing anything else, so the order is kept.
+
+    Waiting in a lane does not take one of the application's running slots (LaneApplication only takes
+    one once the update is at the head of its lane), so a flooding user holds one slot at most. No update
+    is dropped, a command or the text a conversation waits for may be among them. Updates queued past
+    max_pending are counted in sportsfinder_user_lane_overflow_updates_total, and `on_overflow(telegram_id)`
+    is awaited once until the lane empties again, so the user can be told to slow down.
+    """
+
+    def __init__(self, max_pending=20, on_overflow=None):
+        self.max_pending = max_pending
+        self.on_overflow = on_overflow
+        self._lanes = {}  # telegramId -> Lane
+
+    async def run(self, update, process):
+        """Await process(update) in the lane of the update's user."""
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            return await process(update)
+
+        lane = self._lanes.get(user.id)
+        if lane is None:
+            lane = self._lanes[user.id] = Lane()
+        if lane.pending >= self.max_pending:
+            LANE_OVERFLOW_UPDATES.inc()
+            if not lane.told:
+                lane.told = True
+                logger.warning("User %s has %d updates queued", user.id, lane.pending)
+                if self.on_overflow is not None:
+                    await self.on_overflow(user.id)
+
+        lane.pending += 1
+        try:
+            async with lane.lock:
+                return await process(update)
+        finally:
+            lane.pending -= 1
+            if lane.pending == 0:
+                del self._lanes[user.id]
+
+
+class LaneApplication(Application):
+    """Application that processes each user's updates in their lane, at most `running_updates` at a time.
+
+    Set it up with ApplicationBuilder().application_class(LaneApplication, {"user_lanes": ..., "running_updates": ...})
+    and a large concurrent_updates: PTB takes its concurrent_updates slot before process_update, so with
+    a small one every update waiting in a lane would hold a slot. running_updates is taken at the head
+    of the lane instead.
+    """
+
+    def __init__(self, *, user_lanes, running_updates, **kwargs):
+        super().__init__(**kwargs)
+        self.user_lanes = user_lanes
+        self.running_updates = asyncio.BoundedSemaphore(running_updates or 1)
+
+    async def process_update(self, update):
+        await self.user_lanes.run(update, self._process_running)
+
+    async def _process_running(self, update):
+        async with self.running_updates:
+            await super().process_update(update)
+
+
+def iter_handlers(handlers):
+    """Every handler, including the ones nested inside ConversationHandlers."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from iter_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from iter_handlers(state_handlers)
+            yield from iter_handlers(handler.fallbacks)
+        else:
+            yield handler
+
+
+def wrap_handler_callbacks(application, wrapper):
+    """Wrap the callback of every handler registered on the application."""
+    for handlers in application.handlers.values():
+        for handler in iter_handlers(handlers):
+            handler.callback = wrapper(handler.callback)
@@ -0,0 +1,89 @@
+"""Leveled, structured logging for the bot.
+
+Modules log through `logging.getLogger(__name__)` with %-style arguments, so a message that is filtered
+out by its level is never formatted. Fields passed via `extra` are kept as structured fields: appended
+as key=value in text output, or as JSON keys with LOG_FORMAT=json.
+
+    LOG_LEVEL=INFO                              level of every logger without its own level
+    LOG_LEVELS=bot.matching=DEBUG,outbox=WARNING  per-module levels
+    LOG_FORMAT=text                             "text" or "json" (one object per line)
+    LOG_TRACE_SAMPLE_RATE=0.01                  share of per-candidate DEBUG traces that are logged
+"""
+import datetime
+import json
+import logging
+import random
+import sys
+
+# Attributes every LogRecord has, anything else was passed through `extra`
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+# Libraries that log every single request at INFO
+QUIET_LOGGERS = {"httpx": logging.WARNING, "apscheduler": logging.WARNING}
+
+
+def extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in STANDARD_ATTRIBUTES}
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        message = super().format(record)
+        fields = extra_fields(record)
+        if fields:
+            message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(extra_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def parse_levels(spec):
+    """"bot.matching=DEBUG,outbox=WARNING" -> {"bot.matching": "DEBUG", "outbox": "WARNING"}"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level="INFO", module_levels="", log_format="text"):
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+
+    for name, quiet_level in QUIET_LOGGERS.items():
+        logging.getLogger(name).setLevel(quiet_level)
+    for name, module_level in parse_levels(module_levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+
+class TraceSampler:
+    """Decides whether a high-volume DEBUG trace is logged.
+
+    Check `sampled()` before building the trace's arguments: while the logger is above DEBUG it costs a
+    single level check, and at DEBUG only `rate` of the traces are logged.
+    """
+
+    def __init__(self, logger, rate):
+        self.logger = logger
+        self.rate = rate
+
+    def sampled(self):
+        return self.rate > 0 and self.logger.isEnabledFor(logging.DEBUG) and random.random() < self.rate
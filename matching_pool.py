@@ -0,0 +1,199 @@
+import itertools
+
+from preferences import ANY_GENDER
+
+
+AGE_BUCKET_SIZE = 5  # Width (in years) of the age buckets used by the age index
+
+
+# Gives every distinct value its own bit, so a set of values becomes an int and set checks become `&`
+class BitInterner:
+    def __init__(self):
+        self.bits = {}  # value -> bit
+
+    def bit(self, value):
+        bit = self.bits.get(value)
+        if bit is None:
+            # Never freed: locations, skill levels and genders come from small fixed lists in the apps
+            bit = self.bits[value] = 1 << len(self.bits)
+        return bit
+
+    def mask(self, values):
+        mask = 0
+        for value in values:
+            mask |= self.bit(value)
+        return mask
+
+
+LOCATION_BITS = BitInterner()
+SKILL_BITS = BitInterner()
+GENDER_BITS = BitInterner()
+ANY = -1  # Mask that every bit passes
+
+
+def popcount(mask):
+    return bin(mask).count("1")
+
+
+# A user waiting for a match in one sport, reduced to what the match check needs: its profile as bits
+# and its preferences as masks over those bits. The User document itself is not kept.
+class PoolEntry:
+    __slots__ = (
+        "telegram_id", "sport", "username", "display_name", "age", "gender", "skill_level", "preferences",
+        "gender_bit", "skill_bit", "gender_mask", "skill_mask", "location_mask", "min_age", "max_age", "seq",
+    )
+
+    def __init__(self, user, sport, seq, preferences):
+        self.telegram_id = user["telegramId"]
+        self.sport = sport
+        self.username = user.get("username", "Unknown")
+        self.display_name = user.get("displayName", "Unknown")
+        self.age = int(user.get("age", 0))
+        self.gender = user.get("gender")
+        self.skill_level = user.get("sports", {}).get(sport, "Unknown")
+        # Compiled SportPreferences (see preferences.py), shared with the preference cache
+        self.preferences = preferences
+        self.gender_bit = GENDER_BITS.bit(self.gender)
+        self.skill_bit = SKILL_BITS.bit(self.skill_level)
+        self.gender_mask = ANY if preferences.gender_preference in ANY_GENDER else GENDER_BITS.bit(preferences.gender_preference)
+        self.skill_mask = SKILL_BITS.mask(preferences.skill_levels) if preferences.skill_levels else ANY
+        self.location_mask = LOCATION_BITS.mask(preferences.locations)  # 0 without locations: never matches
+        self.min_age, self.max_age = preferences.age_range
+        self.seq = seq  # Order in which users started waiting
+
+    @property
+    def locations(self):
+        return self.preferences.locations
+
+    def accepts(self, other):
+        """Check this user's preferences against the other user's profile."""
+        return bool(
+            other.gender_bit & self.gender_mask
+            and self.min_age <= other.age <= self.max_age
+            and other.skill_bit & self.skill_mask
+            and other.location_mask & self.location_mask
+        )
+
+    def matches(self, other):
+        """accepts() in both directions, in one call: the check the matching loops run for every candidate."""
+        return bool(
+            self.location_mask & other.location_mask
+            and other.gender_bit & self.gender_mask
+            and self.gender_bit & other.gender_mask
+            and self.min_age <= other.age <= self.max_age
+            and other.min_age <= self.age <= other.max_age
+            and other.skill_bit & self.skill_mask
+            and self.skill_bit & other.skill_mask
+        )
+
+
+# Secondary indexes over the users waiting for a single sport
+class SportIndex:
+    def __init__(self):
+        self.members = set()
+        self.by_location = {}
+        self.by_gender = {}
+        self.by_age_bucket = {}
+
+    @staticmethod
+    def _add(index, key, telegram_id):
+        index.setdefault(key, set()).add(telegram_id)
+
+    @staticmethod
+    def _discard(index, key, telegram_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(telegram_id)
+            if not ids:
+                del index[key]
+
+    def add(self, entry):
+        self.members.add(entry.telegram_id)
+        for location in entry.locations:
+            self._add(self.by_location, location, entry.telegram_id)
+        self._add(self.by_gender, entry.gender, entry.telegram_id)
+        self._add(self.by_age_bucket, entry.age // AGE_BUCKET_SIZE, entry.telegram_id)
+
+    def remove(self, entry):
+        self.members.discard(entry.telegram_id)
+        for location in entry.locations:
+            self._discard(self.by_location, location, entry.telegram_id)
+        self._discard(self.by_gender, entry.gender, entry.telegram_id)
+        self._discard(self.by_age_bucket, entry.age // AGE_BUCKET_SIZE, entry.telegram_id)
+
+    def candidate_ids(self, searcher):
+        """Ids of waiting users who can satisfy the searcher's location, gender and age preferences."""
+        # Location first: it is usually the most selective and a common location is always required
+        ids = set()
+        for location in searcher.locations:
+            ids.update(self.by_location.get(location, ()))
+        if not ids:
+            return ids
+
+        if searcher.gender_mask != ANY:
+            ids &= self.by_gender.get(searcher.preferences.gender_preference, set())
+
+        first_bucket = searcher.min_age // AGE_BUCKET_SIZE
+        last_bucket = searcher.max_age // AGE_BUCKET_SIZE
+        if last_bucket - first_bucket < len(self.by_age_bucket):
+            in_age_range = set()
+            for bucket in range(first_bucket, last_bucket + 1):
+                in_age_range.update(self.by_age_bucket.get(bucket, ()))
+            ids &= in_age_range
+
+        return ids
+
+
+# In-memory pool of users with wantToBeMatched set, kept per sport
+class WaitingPool:
+    def __init__(self):
+        self.entries = {}  # telegramId -> PoolEntry
+        self.sports = {}  # sport -> SportIndex
+        self._seq = itertools.count()
+
+    def add(self, user, sport, preferences):
+        """Add (or move) a user into the waiting pool for a sport and return the pool entry."""
+        self.remove(user["telegramId"])
+        return self._insert(PoolEntry(user, sport, next(self._seq), preferences))
+
+    def refresh(self, user, sport, preferences):
+        """Re-index a user whose profile changed. They keep their place if they were already waiting for the sport."""
+        previous = self.remove(user["telegramId"])
+        seq = previous.seq if previous is not None and previous.sport == sport else next(self._seq)
+        return self._insert(PoolEntry(user, sport, seq, preferences))
+
+    def _insert(self, entry):
+        self.entries[entry.telegram_id] = entry
+        self.sports.setdefault(entry.sport, SportIndex()).add(entry)
+        return entry
+
+    def remove(self, telegram_id):
+        entry = self.entries.pop(telegram_id, None)
+        if entry is not None:
+            self.sports[entry.sport].remove(entry)
+        return entry
+
+    def get(self, telegram_id):
+        return self.entries.get(telegram_id)
+
+    def waiting(self, sport):
+        """Entries of everyone waiting for a sport."""
+        index = self.sports.get(sport)
+        return [self.entries[telegram_id] for telegram_id in index.members] if index else []
+
+    def find_matches(self, searcher):
+        """Yield mutually compatible waiting users for the searcher, longest waiting first."""
+        index = self.sports.get(searcher.sport)
+        if index is None:
+            return
+
+        candidates = [
+            self.entries[telegram_id]
+            for telegram_id in index.candidate_ids(searcher)
+            if telegram_id != searcher.telegram_id
+        ]
+        candidates.sort(key=lambda entry: entry.seq)
+
+        for candidate in candidates:
+            if searcher.matches(candidate):
+                yield candidate
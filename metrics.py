@@ -0,0 +1,219 @@
+"""Prometheus metrics for the bot, served in the text exposition format.
+
+The few metric types needed here are kept in plain dicts instead of pulling in a client library, and
+`serve` is a minimal asyncio HTTP server, so the endpoint works the same in polling and webhook mode.
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import time
+
+# Seconds, from a cached lookup up to a slow Bot API call
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MAX_SHAPE_LENGTH = 200
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    async def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = await metric.collect()
+            except Exception as e:
+                # One broken collector (e.g. MongoDB is down) must not take the whole scrape with it
+                logger.warning("Error collecting metric %s: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}  # label values tuple -> value
+        registry.metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key):
+        return list(zip(self.label_names, key))
+
+    async def collect(self):
+        return [(self.name, self._labels(key), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down. With `collect`, the value is read at scrape time instead of being set.
+
+    `collect` may be a function or a coroutine function, and returns the value, or a dict of label values
+    tuple -> value for labelled gauges.
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY, collect=None):
+        super().__init__(name, help, labels, registry)
+        self.collector = collect
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    async def collect(self):
+        if self.collector is not None:
+            values = self.collector()
+            if inspect.isawaitable(values):
+                values = await values
+            self.values = values if isinstance(values, dict) else {(): values}
+        return await super().collect()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["counts"][index] += 1
+                break
+        series["sum"] += value
+        series["count"] += 1
+
+    async def collect(self):
+        samples = []
+        for key, series in self.values.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + [("le", bound)], cumulative))
+            samples.append((f"{self.name}_bucket", labels + [("le", float("inf"))], series["count"]))
+            samples.append((f"{self.name}_sum", labels, series["sum"]))
+            samples.append((f"{self.name}_count", labels, series["count"]))
+        return samples
+
+
+HANDLER_SECONDS = Histogram("sportsfinder_handler_seconds", "Time spent in each update handler", ["handler", "outcome"])
+MONGO_SECONDS = Histogram(
+    "sportsfinder_mongo_operation_seconds", "Time of MongoDB operations, including the wait for a database thread",
+    ["collection", "operation", "shape", "outcome"],
+)
+OUTBOX_SEND_SECONDS = Histogram("sportsfinder_outbox_send_seconds", "Duration of outgoing Bot API calls", ["method", "outcome"])
+OUTBOX_DELAY_SECONDS = Histogram(
+    "sportsfinder_outbox_delay_seconds", "Time from queueing an outgoing call until it completed, including rate limiting",
+    ["method"], buckets=LATENCY_BUCKETS + (30, 60, 300),
+)
+
+
+def time_handler(callback):
+    """Wrap a handler callback so its duration is recorded under the callback's name."""
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await callback(update, context)
+            outcome = "ok"
+            return result
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=callback.__name__, outcome=outcome)
+
+    return timed
+
+
+def query_shape(query):
+    """Fields and operators of a filter or pipeline with the values left out, e.g. `$or(userAId|userBId),status`.
+
+    The bot only issues a fixed set of query shapes, so this keeps the label cardinality bounded.
+    """
+    if isinstance(query, list):
+        # Aggregation pipeline: stage names, with the shape of $match stages
+        return ">".join(
+            f"{stage}({query_shape(spec)})" if stage == "$match" else stage
+            for step in query for stage, spec in step.items()
+        )[:MAX_SHAPE_LENGTH]
+    if not isinstance(query, dict):
+        return ""
+
+    parts = []
+    for key, value in sorted(query.items()):
+        if key in ("$or", "$and", "$nor") and isinstance(value, list):
+            parts.append(f"{key}({'|'.join(query_shape(branch) for branch in value)})")
+        elif isinstance(value, dict) and value and all(operator.startswith("$") for operator in value):
+            parts.append(f"{key}{''.join(sorted(value))}")
+        else:
+            parts.append(key)
+    return ",".join(parts)[:MAX_SHAPE_LENGTH]
+
+
+async def serve(host, port, registry=REGISTRY):
+    """Serve the registry at /metrics. Returns the asyncio server, close() it to stop."""
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Headers are not needed
+            parts = request_line.split()
+            path = parts[1].split(b"?")[0] if len(parts) > 1 else b""
+            if path == b"/metrics":
+                status, body = "200 OK", (await registry.render()).encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,85 @@
+"""One-time migration of User documents to native, typed match preferences.
+
+Rewrites every User whose matchPreferences is a JSON string (or has untyped values) into a
+native subdocument with int age ranges and string lists, and coerces a string `age` to an int.
+A document is only rewritten if it has not changed since it was read.
+
+Usage: python migrate_preferences.py [--dry-run] [--batch-size 500]
+"""
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+import argparse
+import os
+
+from preferences import normalize_match_preferences
+
+
+def migrated_fields(user):
+    """The fields to $set for one User, or None if it is already migrated. Raises ValueError if it cannot be."""
+    raw = user.get("matchPreferences")
+    fields = {}
+
+    if raw is not None:
+        normalized = normalize_match_preferences(raw)
+        if normalized is None:
+            raise ValueError("matchPreferences is not valid JSON")
+        if normalized != raw:
+            fields["matchPreferences"] = normalized
+
+    age = user.get("age")
+    if isinstance(age, str) and age.strip():
+        fields["age"] = int(age)
+
+    return fields or None
+
+
+def migrate(users, dry_run=False, batch_size=500):
+    counts = {"checked": 0, "migrated": 0, "skipped": 0, "failed": 0}
+    operations = []
+
+    def flush():
+        if operations and not dry_run:
+            result = users.bulk_write(operations, ordered=False)
+            # Documents edited by the web apps while we were running are left alone
+            counts["skipped"] += len(operations) - result.matched_count
+            counts["migrated"] -= len(operations) - result.matched_count
+        operations.clear()
+
+    projection = {"telegramId": 1, "matchPreferences": 1, "age": 1}
+    for user in users.find({}, projection, batch_size=batch_size):
+        counts["checked"] += 1
+        try:
+            fields = migrated_fields(user)
+        except (TypeError, ValueError, IndexError, AttributeError) as e:
+            print(f"Cannot migrate user {user.get('telegramId')}: {e}")
+            counts["failed"] += 1
+            continue
+        if fields is None:
+            continue
+
+        unchanged = {"_id": user["_id"], "matchPreferences": user.get("matchPreferences"), "age": user.get("age")}
+        operations.append(UpdateOne(unchanged, {"$set": fields}))
+        counts["migrated"] += 1
+        if len(operations) >= batch_size:
+            flush()
+
+    flush()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be rewritten")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.getenv("DATABASE_URL"))
+    db = client[os.getenv("DATABASE_NAME", "test_database")]
+
+    counts = migrate(db["User"], dry_run=args.dry_run, batch_size=args.batch_size)
+    prefix = "Would migrate" if args.dry_run else "Migrated"
+    print(
+        f"{prefix} {counts['migrated']} of {counts['checked']} users "
+        f"({counts['skipped']} changed during the run, {counts['failed']} could not be parsed)"
+    )
@@ -0,0 +1,220 @@
+"""Local stand-ins for Telegram and MongoDB, shared by the offline tools (benchmark.py and friends).
+
+OfflineBot is a real ExtBot whose HTTP layer is replaced: every Bot API call is recorded and answered
+locally, so handlers run unchanged against real Update objects without a token or network.
+"""
+from telegram import InlineKeyboardMarkup, Update
+from telegram.ext import Application, ConversationHandler, ExtBot
+import asyncio
+import itertools
+from collections import Counter
+import os
+import time
+
+from lanes import LaneApplication
+from profiling import record_telegram
+
+OFFLINE_TOKEN = "123456:offline"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "SportsFinder", "username": "sportsfinder_bot"}
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+class OfflineBot(ExtBot):
+    """Bot that records every API call instead of sending it. `api_latency` simulates Telegram's response time."""
+
+    def __init__(self, token=OFFLINE_TOKEN, api_latency=0.0, **kwargs):
+        super().__init__(token, **kwargs)
+        self._offline_state = {"api_latency": api_latency, "calls": []}
+
+    @property
+    def calls(self):
+        """List of (endpoint, data) for every Bot API call made so far."""
+        return self._offline_state["calls"]
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        self.calls.append((endpoint, data))
+        if self._offline_state["api_latency"]:
+            await asyncio.sleep(self._offline_state["api_latency"])
+            record_telegram(self._offline_state["api_latency"])  # No HTTP request to time, see profiling.py
+
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            return {
+                "message_id": next(_message_ids),
+                "date": int(time.time()),
+                "chat": {"id": data.get("chat_id", 0), "type": "private"},
+                "from": BOT_USER,
+                "text": data.get("text", ""),
+            }
+        if endpoint == "copyMessage":
+            return {"message_id": next(_message_ids)}
+        return True
+
+    def messages_to(self, chat_id):
+        """Data of every message sent or edited in a chat, oldest first."""
+        return [
+            data for endpoint, data in self.calls
+            if endpoint in ("sendMessage", "editMessageText", "copyMessage") and data.get("chat_id") == chat_id
+        ]
+
+    def last_keyboard(self, chat_id):
+        """callback_data of every button of the last inline keyboard sent to a chat, row by row."""
+        for data in reversed(self.messages_to(chat_id)):
+            markup = data.get("reply_markup")
+            if isinstance(markup, InlineKeyboardMarkup):
+                return [button.callback_data for row in markup.inline_keyboard for button in row if button.callback_data]
+        return []
+
+
+def telegram_user(user):
+    """Telegram `from` object for a User document."""
+    return {"id": user["telegramId"], "is_bot": False, "first_name": user.get("displayName", "Player"), "username": user.get("username")}
+
+
+def message_data(user, text):
+    data = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user["telegramId"], "type": "private"},
+        "from": telegram_user(user),
+        "text": text,
+    }
+    if text.startswith("/"):
+        data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return data
+
+
+def message_update(bot, user, text):
+    """Update for a text message or /command sent by a user."""
+    return Update.de_json({"update_id": next(_update_ids), "message": message_data(user, text)}, bot)
+
+
+# Attachments for media_update, file ids are never resolved offline
+MEDIA = {
+    "photo": {"photo": [{"file_id": "photo", "file_unique_id": "photo", "width": 1280, "height": 960}], "caption": "Look at this court"},
+    "voice": {"voice": {"file_id": "voice", "file_unique_id": "voice", "duration": 4}},
+    "sticker": {"sticker": {
+        "file_id": "sticker", "file_unique_id": "sticker", "type": "regular",
+        "width": 512, "height": 512, "is_animated": False, "is_video": False,
+    }},
+    "location": {"location": {"latitude": 1.3521, "longitude": 103.8198}},
+}
+
+
+def media_update(bot, user, kind):
+    """Update for a non-text message (one of MEDIA) sent by a user."""
+    data = message_data(user, "")
+    del data["text"]
+    data.update(MEDIA[kind])
+    return Update.de_json({"update_id": next(_update_ids), "message": data}, bot)
+
+
+def callback_update(bot, user, callback_data):
+    """Update for a user tapping an inline keyboard button."""
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user["telegramId"], "type": "private"},
+        "from": BOT_USER,
+        "text": "",
+    }
+    callback_query = {
+        "id": str(next(_update_ids)),
+        "from": telegram_user(user),
+        "chat_instance": str(user["telegramId"]),
+        "data": callback_data,
+        "message": message,
+    }
+    return Update.de_json({"update_id": next(_update_ids), "callback_query": callback_query}, bot)
+
+
+def import_bot(store="memory", url=None, database_name="sportsfinder_offline"):
+    """Import bot.py configured for offline use, backed by a local mongod or an in-memory store.
+
+    The in-memory store needs the optional `mongomock` package.
+    """
+    if store == "memory":
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("The in-memory store needs mongomock (pip install mongomock), or use a local mongod")
+        os.environ["DB_POOL_SIZE"] = "1"  # mongomock is not thread-safe
+    # MongoClient connects lazily, so with the in-memory store this server is never contacted
+    os.environ["DATABASE_URL"] = url or "mongodb://localhost:27017"
+    if database_name == "test_database":
+        raise SystemExit("Refusing to run against the bot's own database")
+
+    # bot.py reads its configuration at import time
+    os.environ["DATABASE_NAME"] = database_name
+    os.environ.setdefault("BOT_TOKEN", OFFLINE_TOKEN)
+    os.environ["BATCH_MATCH_INTERVAL"] = "0"
+    # Everything goes to a local stand-in, so Telegram's rate limits do not apply
+    os.environ["OUTBOX_GLOBAL_RATE"] = os.environ["OUTBOX_CHAT_RATE"] = os.environ["OUTBOX_CHAT_BURST"] = "1000000"
+    import bot
+
+    if store == "memory":
+        bot.database.use(mongomock.MongoClient()[database_name])
+    else:
+        bot.database.client.drop_database(database_name)
+    return bot
+
+
+def handler_name(application, update):
+    """Name of the callback that will handle an update, "unhandled" if none will."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            check = handler.check_update(update)
+            if check is None or check is False:
+                continue
+            if isinstance(handler, ConversationHandler):
+                handler = check[1]  # (conversation key, state handler, its check result)
+            return handler.callback.__name__
+    return "unhandled"
+
+
+class HandlerErrors:
+    """Error handler counting the exceptions of handler callbacks, which process_update only logs otherwise."""
+
+    def __init__(self):
+        self.counts = Counter()  # handler name -> exceptions
+
+    async def __call__(self, update, context):
+        name = handler_name(context.application, update) if isinstance(update, Update) else "unhandled"
+        self.counts[name] += 1
+        print(f"Error in {name}: {context.error!r}")
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+def build_application(bot_module, offline_bot):
+    """Application wired with the real handlers and user lanes of bot.py, talking to `offline_bot`.
+
+    Exceptions raised by handlers are counted by the HandlerErrors in handler_errors(application).
+    """
+    # The offline tools call process_update concurrently themselves, CONCURRENT_UPDATES (0 by default) would serialize them
+    running_updates = bot_module.CONCURRENT_UPDATES or bot_module.MAX_QUEUED_UPDATES
+    application = (
+        Application.builder()
+        .application_class(LaneApplication, {"user_lanes": bot_module.user_lanes, "running_updates": running_updates})
+        .bot(offline_bot)
+        .build()
+    )
+    bot_module.setup_handlers(application)
+    application.add_error_handler(HandlerErrors())
+    return application
+
+
+def handler_errors(application):
+    """The HandlerErrors build_application registered on an application."""
+    return next(callback for callback in application.error_handlers if isinstance(callback, HandlerErrors))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
@@ -0,0 +1,148 @@
+from collections import deque
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from metrics import OUTBOX_DELAY_SECONDS, OUTBOX_SEND_SECONDS
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def idle(self):
+        """True once the bucket is full again, i.e. it no longer remembers any sends."""
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+def _consume_exception(future):
+    # Nobody has to await a queued send, so don't warn about failures nobody retrieved
+    if not future.cancelled():
+        future.exception()
+
+
+class Outbox:
+    """Rate-limited outbound message scheduler.
+
+    Handlers queue Bot API calls and return right away. Every chat has its own FIFO queue and worker,
+    so different chats are sent to in parallel while each chat's messages stay in order. Sends respect
+    a global token bucket and a per-chat one, and a 429 is retried after the server's retry_after.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_queued=10000, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.bot = None
+        self.queued = 0
+        self._queues = {}  # chat_id -> deque of (method, kwargs, future, queued_at)
+        self._buckets = {}  # chat_id -> TokenBucket
+        self._workers = {}  # chat_id -> asyncio.Task
+
+    def start(self, bot):
+        self.bot = bot
+
+    async def stop(self, timeout=10):
+        """Give queued messages up to `timeout` seconds to go out, then cancel the rest."""
+        workers = list(self._workers.values())
+        if workers:
+            done, pending = await asyncio.wait(workers, timeout=timeout)
+            for worker in pending:
+                worker.cancel()
+            if pending:
+                logger.warning("Outbox stopped with %d messages still queued", self.queued)
+
+    def submit(self, chat_id, method, /, **kwargs):
+        """Queue a Bot API call (e.g. "send_message") for a chat. Returns a future with its result."""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        if self.queued >= self.max_queued:
+            logger.warning("Outbox is full, dropping %s to chat %s", method, chat_id)
+            future.set_exception(RuntimeError("outbox is full"))
+            return future
+
+        self._queues.setdefault(chat_id, deque()).append((method, kwargs, future, time.monotonic()))
+        self.queued += 1
+        if chat_id not in self._workers:
+            if len(self._buckets) > self.max_queued:
+                self._prune_buckets()
+            self._workers[chat_id] = asyncio.create_task(self._run_chat(chat_id))
+        return future
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(chat_id, "send_message", chat_id=chat_id, text=text, **kwargs)
+
+    def _prune_buckets(self):
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._workers and bucket.idle():
+                del self._buckets[chat_id]
+
+    async def _run_chat(self, chat_id):
+        queue = self._queues[chat_id]
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        try:
+            while queue:
+                method, kwargs, future, queued_at = queue.popleft()
+                self.queued -= 1
+                try:
+                    future.set_result(await self._send(bucket, method, kwargs))
+                except Exception as e:
+                    logger.warning("Error in %s to chat %s: %s", method, chat_id, e)
+                    future.set_exception(e)
+                OUTBOX_DELAY_SECONDS.observe(time.monotonic() - queued_at, method=method)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+            # Forget the chat's rate limit state once it could not hold anything back any more
+            if bucket.idle():
+                self._buckets.pop(chat_id, None)
+
+    async def _send(self, bucket, method, kwargs):
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            started = time.monotonic()
+            try:
+                result = await getattr(self.bot, method)(**kwargs)
+                OUTBOX_SEND_SECONDS.observe(time.monotonic() - started, method=method, outcome="ok")
+                return result
+            except RetryAfter as e:
+                OUTBOX_SEND_SECONDS.observe(time.monotonic() - started, method=method, outcome="retry_after")
+                # Flood control: wait exactly as long as Telegram asks, this does not use up a retry
+                await asyncio.sleep(e.retry_after)
+            except (BadRequest, Forbidden):
+                OUTBOX_SEND_SECONDS.observe(time.monotonic() - started, method=method, outcome="rejected")
+                raise  # e.g. the user blocked the bot, retrying will not help
+            except NetworkError:
+                OUTBOX_SEND_SECONDS.observe(time.monotonic() - started, method=method, outcome="network_error")
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+ANY_GENDER = ("No preference", "Either")
+DEFAULT_AGE_RANGE = (1, 100)
+
+
+def parse_match_preferences(raw):
+    """Return matchPreferences as a dictionary, or None if it is a string that is not valid JSON."""
+    if raw is None:
+        return {}
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+    return raw if isinstance(raw, dict) else None
+
+
+def normalize_sport_preferences(sport_preferences):
+    """Typed copy of one sport's preferences: ints for the age range, lists of strings for the rest."""
+    sport_preferences = sport_preferences or {}
+    age_range = sport_preferences.get("ageRange") or DEFAULT_AGE_RANGE
+    return {
+        "ageRange": [int(age_range[0]), int(age_range[1])],
+        "genderPreference": sport_preferences.get("genderPreference") or "No preference",
+        "skillLevels": [str(level) for level in sport_preferences.get("skillLevels") or []],
+        "locationPreferences": [str(location) for location in sport_preferences.get("locationPreferences") or []],
+    }
+
+
+def normalize_match_preferences(raw):
+    """Native, typed matchPreferences subdocument, or None if the raw value cannot be parsed."""
+    match_preferences = parse_match_preferences(raw)
+    if match_preferences is None:
+        return None
+    return {sport: normalize_sport_preferences(sport_preferences) for sport, sport_preferences in match_preferences.items()}
+
+
+# One sport's preferences, compiled once so the matching loop never parses or coerces anything
+class SportPreferences:
+    __slots__ = ("age_range", "gender_preference", "skill_levels", "locations")
+
+    def __init__(self, age_range=DEFAULT_AGE_RANGE, gender_preference="No preference", skill_levels=(), locations=()):
+        self.age_range = tuple(age_range)
+        self.gender_preference = gender_preference
+        self.skill_levels = frozenset(skill_levels)
+        self.locations = frozenset(locations)
+
+    @classmethod
+    def from_dict(cls, sport_preferences):
+        normalized = normalize_sport_preferences(sport_preferences)
+        return cls(
+            normalized["ageRange"],
+            normalized["genderPreference"],
+            normalized["skillLevels"],
+            normalized["locationPreferences"],
+        )
+
+    def __repr__(self):
+        return (
+            f"SportPreferences(age_range={self.age_range}, gender={self.gender_preference!r}, "
+            f"skills={sorted(self.skill_levels)}, locations={sorted(self.locations)})"
+        )
+
+
+# Used for a sport the user has no (valid) preferences for; with no locations it never matches
+DEFAULT_SPORT_PREFERENCES = SportPreferences()
+
+
+def compile_match_preferences(raw):
+    """Compile matchPreferences into {sport: SportPreferences}, or None if it cannot be parsed."""
+    match_preferences = parse_match_preferences(raw)
+    if match_preferences is None:
+        return None
+    compiled = {}
+    for sport, sport_preferences in match_preferences.items():
+        try:
+            compiled[sport] = SportPreferences.from_dict(sport_preferences)
+        except (TypeError, ValueError, IndexError, AttributeError):
+            logger.info("Invalid match preferences for %s, ignoring them", sport)
+    return compiled
+
+
+def compile_sport_preferences(raw, sport):
+    """Compile one sport of matchPreferences, DEFAULT_SPORT_PREFERENCES if it is missing or invalid."""
+    match_preferences = parse_match_preferences(raw)
+    if not match_preferences or sport not in match_preferences:
+        return DEFAULT_SPORT_PREFERENCES
+    try:
+        return SportPreferences.from_dict(match_preferences[sport])
+    except (TypeError, ValueError, IndexError, AttributeError):
+        logger.info("Invalid match preferences for %s, ignoring them", sport)
+        return DEFAULT_SPORT_PREFERENCES
+
+
+def preferences_version(user):
+    """Changes whenever the user's preferences may have changed, or None if that cannot be told cheaply."""
+    if user.get("updatedAt") is not None:
+        return user["updatedAt"]
+    raw = user.get("matchPreferences")
+    # A JSON string is its own version (and hashing a str is cached by Python)
+    return raw if isinstance(raw, str) else None
+
+
+class PreferenceCache:
+    """Compiled preferences per telegramId, recompiled only when the user's preferences version changes.
+
+    Whole documents (get) and single sports (get_sport) are cached apart, so candidates read with only the
+    searched sport's preferences (see candidate_query.py) never stand in for all of a user's preferences.
+    """
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # telegramId -> (version, compiled preferences)
+        self._sports = OrderedDict()  # telegramId -> (version, {sport: SportPreferences})
+
+    def get(self, user):
+        """Compiled {sport: SportPreferences} for a User document, or None if its preferences are invalid."""
+        telegram_id = user.get("telegramId")
+        version = preferences_version(user)
+        cached = self._entries.get(telegram_id)
+        if cached is not None and version is not None and cached[0] == version:
+            self._entries.move_to_end(telegram_id)
+            return cached[1]
+
+        compiled = compile_match_preferences(user.get("matchPreferences"))
+        if version is not None:
+            self._entries[telegram_id] = (version, compiled)
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def get_sport(self, user, sport):
+        """Compiled SportPreferences of one sport, from a whole User document or one holding only that sport."""
+        telegram_id = user.get("telegramId")
+        version = preferences_version(user)
+        cached = self._sports.get(telegram_id)
+        if cached is not None and version is not None and cached[0] == version and sport in cached[1]:
+            self._sports.move_to_end(telegram_id)
+            return cached[1][sport]
+
+        compiled = compile_sport_preferences(user.get("matchPreferences"), sport)
+        if version is not None:
+            if cached is None or cached[0] != version:
+                cached = self._sports[telegram_id] = (version, {})
+            cached[1][sport] = compiled
+            self._sports.move_to_end(telegram_id)
+            while len(self._sports) > self.max_size:
+                self._sports.popitem(last=False)
+        return compiled
+
+    def invalidate(self, telegram_id):
+        self._entries.pop(telegram_id, None)
+        self._sports.pop(telegram_id, None)
@@ -0,0 +1,166 @@
+"""Sampled profiling of handler callbacks, and a time breakdown of slow updates.
+
+While profiling is on, every handler callback records how long it waited on MongoDB (database.py) and on
+Bot API calls it awaited itself (ProfilingRequest), the rest being Python code and the event loop. Updates
+slower than `slow_seconds` are logged with that breakdown, and every `every`-th update is run under
+cProfile, its stats written to `directory` as <time>-<handler>-<update type>-<ms>ms.prof (open them
+with `python -m pstats` or snakeviz).
+
+cProfile profiles the whole event loop thread, so with concurrent updates a profile also contains work
+of other updates that ran while this one was waiting. Only one update is profiled at a time.
+Messages queued on the outbox are sent by its own tasks and are not part of any update's time.
+"""
+from telegram.request import HTTPXRequest
+import asyncio
+import contextvars
+import cProfile
+import functools
+import itertools
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Timings of the update whose handler is running in the current task
+update_timings = contextvars.ContextVar("update_timings", default=None)
+
+UPDATE_TYPES = ("callback_query", "message", "edited_message", "channel_post", "inline_query", "my_chat_member")
+
+
+class UpdateTimings:
+    __slots__ = ("task", "mongo", "mongo_calls", "telegram", "telegram_calls")
+
+    def __init__(self):
+        # Tasks started by the handler (e.g. outbox workers) inherit the context, only its own task counts
+        self.task = asyncio.current_task()
+        self.mongo = 0.0
+        self.mongo_calls = 0
+        self.telegram = 0.0
+        self.telegram_calls = 0
+
+
+def current_timings():
+    timings = update_timings.get()
+    if timings is not None and timings.task is asyncio.current_task():
+        return timings
+    return None
+
+
+def record_mongo(seconds):
+    timings = current_timings()
+    if timings is not None:
+        timings.mongo += seconds
+        timings.mongo_calls += 1
+
+
+def record_telegram(seconds):
+    timings = current_timings()
+    if timings is not None:
+        timings.telegram += seconds
+        timings.telegram_calls += 1
+
+
+class ProfilingRequest(HTTPXRequest):
+    """HTTPXRequest that counts the time of each Bot API call towards the update awaiting it."""
+
+    async def do_request(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(*args, **kwargs)
+        finally:
+            record_telegram(time.perf_counter() - started)
+
+
+def update_type(update):
+    for name in UPDATE_TYPES:
+        if getattr(update, name, None) is not None:
+            return name
+    return "other"
+
+
+class HandlerProfiler:
+    """Wraps handler callbacks (see lanes.wrap_handler_callbacks). Switched on and off at runtime with `enabled`."""
+
+    def __init__(self, directory="profiles", every=100, slow_seconds=0.5, enabled=False):
+        self.directory = directory
+        self.every = every  # Profile every Nth update with cProfile, 0 never does
+        self.slow_seconds = slow_seconds  # Log the time breakdown of updates slower than this, 0 never does
+        self.enabled = enabled
+        self.profiles_written = 0
+        self.slow_updates = 0
+        self._updates = itertools.count(1)
+        self._profiling = False
+
+    def wrap(self, callback):
+        @functools.wraps(callback)
+        async def profiled(update, context):
+            if not self.enabled:
+                return await callback(update, context)
+
+            timings = UpdateTimings()
+            token = update_timings.set(timings)
+            profile = None
+            if self.every and next(self._updates) % self.every == 0 and not self._profiling:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                    self._profiling = True
+                except ValueError:
+                    profile = None  # Another profiler is attached to the thread
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                elapsed = time.perf_counter() - started
+                update_timings.reset(token)
+                path = None
+                if profile is not None:
+                    profile.disable()
+                    self._profiling = False
+                    path = self._dump(profile, callback.__name__, update, elapsed)
+                if self.slow_seconds and elapsed >= self.slow_seconds:
+                    self._report_slow(callback.__name__, update, elapsed, timings, path)
+
+        return profiled
+
+    def _dump(self, profile, handler, update, elapsed):
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{handler}-{update_type(update)}-{elapsed * 1000:.0f}ms.prof"
+        path = os.path.join(self.directory, name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(path)
+        except OSError as e:
+            logger.warning("Could not write profile %s: %s", path, e)
+            return None
+        self.profiles_written += 1
+        return path
+
+    def _report_slow(self, handler, update, elapsed, timings, path):
+        self.slow_updates += 1
+        python = max(0.0, elapsed - timings.mongo - timings.telegram)
+        logger.warning(
+            "Slow update in %s: %.0f ms (MongoDB %.0f ms in %d calls, Telegram %.0f ms in %d calls, Python and event loop %.0f ms)",
+            handler, elapsed * 1000, timings.mongo * 1000, timings.mongo_calls, timings.telegram * 1000, timings.telegram_calls, python * 1000,
+            extra={
+                "handler": handler,
+                "update_type": update_type(update),
+                "user_id": update.effective_user.id if update.effective_user else None,
+                "total_ms": round(elapsed * 1000, 1),
+                "mongo_ms": round(timings.mongo * 1000, 1),
+                "mongo_calls": timings.mongo_calls,
+                "telegram_ms": round(timings.telegram * 1000, 1),
+                "telegram_calls": timings.telegram_calls,
+                "python_ms": round(python * 1000, 1),
+                "profile": path,
+            },
+        )
+
+    def status(self):
+        state = "on" if self.enabled else "off"
+        every = f"1 in {self.every} updates" if self.every else "no updates"
+        slow = f"updates over {self.slow_seconds * 1000:.0f} ms" if self.slow_seconds else "no updates"
+        return (
+            f"Profiling is {state}: cProfile on {every} (written to {self.directory}), time breakdown logged for {slow}. "
+            f"{self.profiles_written} profiles written, {self.slow_updates} slow updates so far."
+        )
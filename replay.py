@@ -0,0 +1,103 @@
+"""Replay a recorded update log (see update_log.py) through the real handlers, time-compressed.
+
+The updates are fed to an Application set up by bot.setup_handlers, talking to OfflineBot instead of
+Telegram and to an in-memory store or a local mongod instead of MongoDB (see offline.py). Every update is
+dispatched at its recorded offset divided by --speed, so bursts in the log stay bursts, and the handler
+latency distributions are reported in the same table as benchmark.py.
+
+Every user in the log gets a synthetic profile first, unless --no-profiles is given. Feedback buttons
+recorded in production are signed with the production key and are treated as stale buttons on replay.
+
+Usage: python replay.py UPDATE_LOG [--speed 10] [--store memory|mongod] [--limit N]
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from telegram import Update
+
+import offline
+from benchmark import Recorder
+from synthetic_users import generate_user
+from update_log import log_files, read_updates
+
+
+def user_ids(update_data):
+    """Ids of the users an update comes from."""
+    ids = set()
+    for value in update_data.values():
+        if isinstance(value, dict):
+            sender = value.get("from")
+            if isinstance(sender, dict) and not sender.get("is_bot"):
+                ids.add(sender["id"])
+    return ids
+
+
+async def main(args):
+    paths = [file for path in args.logs for file in log_files(path)]
+    if not paths:
+        sys.exit(f"No update logs found at {', '.join(args.logs)}")
+    entries = list(read_updates(paths))
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        sys.exit("The update logs are empty")
+    print(f"{len(entries)} updates from {len(paths)} files, {entries[-1][0] - entries[0][0]:.0f}s of traffic")
+
+    bot = offline.import_bot(args.store, args.url, args.db)
+    offline_bot = offline.OfflineBot(api_latency=args.api_latency_ms / 1000)
+    application = offline.build_application(bot, offline_bot)
+    await application.initialize()
+    await bot.on_startup(application)
+
+    if args.profiles:
+        rng = random.Random(args.seed)
+        ids = sorted({telegram_id for at, data in entries for telegram_id in user_ids(data)})
+        await bot.database.run(bot.database.db["User"].insert_many, [generate_user(telegram_id, rng) for telegram_id in ids])
+        print(f"Created profiles for {len(ids)} users")
+
+    # Round trip budgets assume benchmark.py's scenario, real traffic has cache misses they do not allow for
+    recorder = Recorder(application, budgets={})
+    first_at = entries[0][0]
+    lag = []  # Seconds each update was dispatched after its scheduled time
+    tasks = []
+    started = time.perf_counter()
+    for at, data in entries:
+        due = (at - first_at) / args.speed if args.speed else 0.0
+        delay = due - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        lag.append(max(0.0, -delay))
+        tasks.append(asyncio.create_task(recorder.process(Update.de_json(data, offline_bot))))
+    names = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await bot.outbox.stop()
+
+    for name in set(names):
+        recorder.wall_time[name] = elapsed
+    lag.sort()
+    print(
+        f"Replayed in {elapsed:.2f}s at {f'{args.speed:g}x' if args.speed else 'full speed'}, {len(offline_bot.calls)} Bot API calls, {recorder.errors} errors,"
+        f" dispatch lag p50 {offline.percentile(lag, 0.5) * 1000:.1f} ms p99 {offline.percentile(lag, 0.99) * 1000:.1f} ms"
+    )
+    recorder.report()
+
+    await bot.on_shutdown(application)
+    await application.shutdown()
+    return 1 if recorder.errors else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("logs", nargs="+", help="update log path (UPDATE_LOG_PATH), its rotated files are included")
+    parser.add_argument("--speed", type=float, default=10.0, help="time compression, 0 dispatches everything at once")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N updates")
+    parser.add_argument("--store", choices=["memory", "mongod"], default="memory", help="in-memory store (needs mongomock) or a local mongod")
+    parser.add_argument("--url", default="mongodb://localhost:27017", help="local mongod for --store mongod")
+    parser.add_argument("--db", default="sportsfinder_replay", help="scratch database, dropped before the run")
+    parser.add_argument("--no-profiles", dest="profiles", action="store_false", help="do not create profiles for the users in the log")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Telegram response time")
+    parser.add_argument("--seed", type=int, default=0)
+    sys.exit(asyncio.run(main(parser.parse_args())))
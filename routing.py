@@ -0,0 +1,86 @@
+from collections import OrderedDict
+import time
+
+
+# Where a matched user's messages go: the partner, the sender's own display name and the match
+class Route:
+    __slots__ = ("partner_id", "display_name", "match_id", "expires_at")
+
+    def __init__(self, partner_id, display_name, match_id, expires_at):
+        self.partner_id = partner_id
+        self.display_name = display_name
+        self.match_id = match_id
+        self.expires_at = expires_at
+
+
+class RoutingTable:
+    """In-process telegramId -> Route table for users in an active match.
+
+    Entries are evicted least-recently-used once max_size is reached, and expire after ttl seconds
+    without use so a route that was changed elsewhere is eventually re-read from MongoDB.
+    """
+
+    def __init__(self, max_size=10000, ttl=6 * 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._routes = OrderedDict()
+
+    def get(self, telegram_id):
+        route = self._routes.get(telegram_id)
+        if route is None:
+            return None
+        now = time.monotonic()
+        if route.expires_at < now:
+            del self._routes[telegram_id]
+            return None
+        route.expires_at = now + self.ttl
+        self._routes.move_to_end(telegram_id)
+        return route
+
+    def set(self, telegram_id, partner_id, display_name, match_id):
+        route = Route(partner_id, display_name, match_id, time.monotonic() + self.ttl)
+        self._routes[telegram_id] = route
+        self._routes.move_to_end(telegram_id)
+        while len(self._routes) > self.max_size:
+            self._routes.popitem(last=False)
+        return route
+
+    def discard(self, telegram_id):
+        self._routes.pop(telegram_id, None)
+
+    def rename(self, telegram_id, display_name):
+        """Update the sender name on a cached route, if there is one."""
+        route = self._routes.get(telegram_id)
+        if route is not None:
+            route.display_name = display_name
+
+    def __len__(self):
+        return len(self._routes)
+
+
+class DisplayNameCache:
+    """telegramId -> displayName of recently matched users, least-recently-used entries are evicted."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._names = OrderedDict()
+
+    def get(self, telegram_id):
+        name = self._names.get(telegram_id)
+        if name is not None:
+            self._names.move_to_end(telegram_id)
+        return name
+
+    def refresh(self, telegram_id, display_name):
+        """Update a cached name, without caching users that are not cached yet."""
+        if telegram_id in self._names:
+            self._names[telegram_id] = display_name
+
+    def set(self, telegram_id, display_name):
+        self._names[telegram_id] = display_name
+        self._names.move_to_end(telegram_id)
+        while len(self._names) > self.max_size:
+            self._names.popitem(last=False)
+
+    def __len__(self):
+        return len(self._names)
@@ -0,0 +1,65 @@
+"""Candidate ranking for match creation, selected with MATCH_SCORING.
+
+Every scorer takes the searcher and its mutually compatible candidates (pool entries, see matching_pool.py)
+and returns them in the order they should be tried. The caller claims the first one that is still free.
+
+    first_fit  the order the matching engine produced them in (longest waiting first for the pool)
+    best       highest compatibility score first, computed for all candidates at once with NumPy
+"""
+import numpy as np
+
+from matching_pool import popcount
+
+SKILL_RANK = {"Beginner": 0, "Intermediate": 1, "Advanced": 2}
+UNKNOWN_SKILL_RANK = 1
+MAX_AGE_GAP = 20  # Years at which age closeness reaches zero
+
+# Relative weight of each score component, every component is between 0 and 1
+DEFAULT_WEIGHTS = {"age": 1.0, "skill": 1.0, "location": 1.0, "wait": 0.5}
+
+
+def first_fit(searcher, candidates):
+    return candidates
+
+
+def score_candidates(searcher, candidates, weights=DEFAULT_WEIGHTS):
+    """Compatibility score of every candidate, as an array in the candidates' order."""
+    count = len(candidates)
+    ages = np.fromiter((candidate.age for candidate in candidates), dtype=np.float64, count=count)
+    skills = np.fromiter(
+        (SKILL_RANK.get(candidate.skill_level, UNKNOWN_SKILL_RANK) for candidate in candidates), dtype=np.float64, count=count
+    )
+    location_mask = searcher.location_mask
+    shared_locations = np.fromiter(
+        (popcount(location_mask & candidate.location_mask) for candidate in candidates), dtype=np.float64, count=count
+    )
+    seqs = np.fromiter((candidate.seq for candidate in candidates), dtype=np.float64, count=count)
+
+    age_closeness = 1 - np.minimum(np.abs(ages - searcher.age), MAX_AGE_GAP) / MAX_AGE_GAP
+    skill_closeness = 1 - np.abs(skills - SKILL_RANK.get(searcher.skill_level, UNKNOWN_SKILL_RANK)) / 2
+    location_overlap = shared_locations / max(popcount(location_mask), 1)
+    # 1 for whoever has waited longest, 0 for the latest to join
+    waited = (seqs.max() - seqs) / max(np.ptp(seqs), 1)
+
+    return (
+        weights["age"] * age_closeness
+        + weights["skill"] * skill_closeness
+        + weights["location"] * location_overlap
+        + weights["wait"] * waited
+    )
+
+
+def best_score(searcher, candidates):
+    candidates = list(candidates)
+    if len(candidates) < 2:
+        return candidates
+    scores = score_candidates(searcher, candidates)
+    # Stable, so equal scores keep the engine's order
+    order = np.argsort(-scores, kind="stable")
+    return [candidates[index] for index in order]
+
+
+SCORERS = {
+    "first_fit": first_fit,
+    "best": best_score,
+}
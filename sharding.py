@@ -0,0 +1,246 @@
+"""Run the bot as several worker processes on one host, each owning the users whose telegramId hashes to it.
+
+    python sharding.py --workers 4        (or BOT_WORKERS=4 python sharding.py)
+
+The receiver process fetches updates from Telegram (polling or webhook, configured like bot.py) and
+hands each one, as a dict, to the multiprocessing queue of the worker that owns its user. Each worker
+imports bot.py in a fresh process and runs its Application on the updates it is given, so a user's
+updates always reach the same worker, in order, and that worker's caches (routing table, display names,
+preferences, waiting pool) only ever hold its own users.
+
+What crosses users, and therefore workers, is coordinated through MongoDB:
+  - Matching runs with MATCH_ENGINE=query, candidates come from the User collection and both users are
+    claimed atomically (claim_pair), so two workers can never match the same user twice.
+  - When a match is created or ended, the worker that did it sends forget_user for the other user to
+    their worker, through that worker's queue, which drops the user's cached route and pool entry.
+  - Only worker 0 runs the batch matcher (pairing a snapshot of every worker's waiting users loaded from
+    MongoDB). A broadcast is sent by the worker of the admin who started it, and resumed by that worker
+    after a restart. The outbox's global rate and the broadcast rate are split between the workers.
+
+The receiver watches the workers and restarts one that dies. If workers keep dying (more than
+MAX_RESTARTS within RESTART_WINDOW seconds, e.g. because MongoDB is unreachable at startup) it stops
+instead of queueing updates nobody handles.
+"""
+from dotenv import load_dotenv
+from queue import Empty, Full
+import argparse
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from logging_setup import configure_logging
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10000  # Updates waiting for a worker before the receiver stops fetching more
+STOP = None  # Queue item telling a worker to shut down
+MAX_RESTARTS = 5  # Worker restarts within RESTART_WINDOW after which the receiver gives up
+RESTART_WINDOW = 300
+
+
+def shard_of(telegram_id, shard_count):
+    """Worker that owns a user. Stable across processes and restarts, unlike hash()."""
+    digest = hashlib.blake2b(str(telegram_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+
+# Worker processes
+
+def run_worker(index, queues):
+    """Entry point of a worker process: configure bot.py for this shard, then handle its queue until STOP."""
+    count = len(queues)
+    os.environ["SHARD_INDEX"] = str(index)
+    os.environ["SHARD_COUNT"] = str(count)
+    os.environ["MATCH_ENGINE"] = "query"  # Other workers' users are only visible in MongoDB
+    os.environ["UPDATE_LOG_PATH"] = ""  # The receiver records the updates
+    global_rate = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+    os.environ["OUTBOX_GLOBAL_RATE"] = str(global_rate / count)
+    # Broadcasts are sent by the admin's worker, and must leave room in that worker's share of the outbox
+    os.environ["BROADCAST_RATE"] = str(float(os.getenv("BROADCAST_RATE", "20")) / count)
+    if index != 0:
+        os.environ["BATCH_MATCH_INTERVAL"] = "0"
+    if int(os.getenv("METRICS_PORT", "0")):
+        os.environ["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + index)
+    # Stopping is the receiver's decision, it sends STOP once it has stopped fetching updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    import bot
+
+    def forget_elsewhere(telegram_ids):
+        for telegram_id in telegram_ids:
+            shard = shard_of(telegram_id, count)
+            if shard == index:
+                continue
+            item = ("forget_user", telegram_id)
+            try:
+                queues[shard].put_nowait(item)
+            except Full:
+                # Called from a handler: wait for room on a thread, never on the event loop
+                asyncio.get_running_loop().run_in_executor(None, queues[shard].put, item)
+
+    bot.forget_elsewhere = forget_elsewhere
+    asyncio.run(serve_shard(bot, bot.application, index, queues[index]))
+
+
+async def serve_shard(bot, application, index, queue):
+    """Feed the shard's queue into the application (set up by bot.py) until STOP arrives."""
+    from telegram import Update
+
+    await application.initialize()
+    await bot.on_startup(application)
+    await application.start()
+    logger.info("Worker %d started", index)
+    try:
+        while True:
+            try:
+                item = await asyncio.to_thread(queue.get, timeout=1)
+            except Empty:
+                continue
+            if item is STOP:
+                break
+            kind, payload = item
+            if kind == "update":
+                await application.update_queue.put(Update.de_json(payload, application.bot))
+            elif kind == "forget_user":
+                bot.forget_user(payload)
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await bot.on_shutdown(application)
+        logger.info("Worker %d stopped", index)
+
+
+# Receiver process
+
+def update_owner(update):
+    """telegramId that decides which worker handles an update."""
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return 0
+
+
+def build_receiver(queues, stopping):
+    from telegram import Update
+    from telegram.ext import Application, TypeHandler
+    from update_log import UpdateRecorder
+
+    async def dispatch(update, context):
+        queue = queues[shard_of(update_owner(update), len(queues))]
+        item = ("update", update.to_dict())
+        try:
+            queue.put_nowait(item)
+        except Full:
+            # Updates are dispatched one at a time, so waiting here also holds back fetching new ones
+            logger.warning("Worker queue is full, waiting for room")
+            while not stopping.is_set():
+                try:
+                    await asyncio.to_thread(queue.put, item, timeout=1)
+                    return
+                except Full:
+                    continue
+
+    application = Application.builder().token(os.getenv("BOT_TOKEN")).build()
+    application.add_handler(TypeHandler(Update, dispatch))
+    if os.getenv("UPDATE_LOG_PATH"):
+        from callback_tokens import derive_secret
+        anonymize = os.getenv("UPDATE_LOG_ANONYMIZE", "true").lower() == "true"
+        secret = os.getenv("CALLBACK_SECRET")
+        recorder = UpdateRecorder(
+            os.environ["UPDATE_LOG_PATH"],
+            max_bytes=int(os.getenv("UPDATE_LOG_MAX_BYTES", str(50 * 1024 * 1024))),
+            backups=int(os.getenv("UPDATE_LOG_BACKUPS", "10")),
+            # The same pseudonyms as a single-process bot would write
+            anonymize_key=(secret.encode() if secret else derive_secret(os.getenv("BOT_TOKEN"))) if anonymize else None,
+        )
+        application.add_handler(TypeHandler(Update, recorder.record), group=-100)
+    return application
+
+
+def run_receiver(application):
+    """Fetch updates like bot.py does, until SIGINT/SIGTERM."""
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        webhook_url = os.getenv("WEBHOOK_URL")
+        if not webhook_url:
+            raise SystemExit("WEBHOOK_URL must be set when BOT_MODE=webhook")
+        webhook_path = os.getenv("WEBHOOK_PATH", "telegram")
+        application.run_webhook(
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("PORT", "8443")),
+            url_path=webhook_path,
+            webhook_url=f"{webhook_url.rstrip('/')}/{webhook_path}",
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+            max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")),
+        )
+    else:
+        application.run_polling()
+
+
+def start_worker(context, index, queues):
+    process = context.Process(target=run_worker, args=(index, queues), name=f"shard-{index}")
+    process.start()
+    return process
+
+
+def watch_workers(context, processes, queues, stopping):
+    """Restart workers that died, on a thread of the receiver. Stops the receiver if they keep dying."""
+    restarts = []  # time.monotonic() of recent restarts
+    while not stopping.wait(1):
+        for index, process in enumerate(processes):
+            if process.is_alive():
+                continue
+            now = time.monotonic()
+            restarts = [at for at in restarts if now - at < RESTART_WINDOW]
+            if len(restarts) >= MAX_RESTARTS:
+                logger.error("Worker %s died with exit code %s after %d restarts, stopping", process.name, process.exitcode, len(restarts))
+                stopping.set()
+                os.kill(os.getpid(), signal.SIGTERM)  # Stops run_polling/run_webhook like a regular shutdown
+                return
+            logger.error("Worker %s died with exit code %s, restarting it", process.name, process.exitcode)
+            restarts.append(now)
+            processes[index] = start_worker(context, index, queues)
+
+
+def main(workers):
+    # Fresh interpreters: a forked copy of the receiver's state (or of a MongoClient) is not safe to use
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(QUEUE_SIZE) for _ in range(workers)]
+    processes = [start_worker(context, index, queues) for index in range(workers)]
+    logger.info("Started %d workers, receiving updates", workers)
+
+    stopping = threading.Event()
+    watcher = threading.Thread(target=watch_workers, args=(context, processes, queues, stopping), name="worker-watcher", daemon=True)
+    watcher.start()
+    try:
+        run_receiver(build_receiver(queues, stopping))
+    finally:
+        stopping.set()
+        watcher.join()
+        for queue in queues:
+            try:
+                queue.put(STOP, timeout=5)
+            except Full:
+                pass  # The worker is stuck or dead, it is terminated below
+        for process in processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                logger.warning("Worker %s did not stop in time, terminating it", process.name)
+                process.terminate()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    configure_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_LEVELS", ""), os.getenv("LOG_FORMAT", "text"))
+    parser = argparse.ArgumentParser(description="Run the bot as several worker processes partitioned by telegramId")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("BOT_WORKERS", str(os.cpu_count() or 1))))
+    args = parser.parse_args()
+    if args.workers < 1:
+        raise SystemExit("--workers must be at least 1")
+    main(args.workers)
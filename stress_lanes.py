@@ -0,0 +1,79 @@
+"""Stress test for user lanes: one user flooding the bot must not hold back everyone else.
+
+One user sends --flood slow updates at once, then a second user sends one. With PTB's concurrent
+update slots taken before the lane, the second user waited for a slot the flood held; with
+LaneApplication they wait for at most one running update. Every flooded update must also be handled,
+in order: none is dropped when the flooder's lane is past max_pending.
+
+Usage: python stress_lanes.py [--running 4] [--flood 10] [--handler-ms 100]
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+import offline
+from lanes import LaneApplication, UserLanes
+
+FLOODER = {"telegramId": 1, "displayName": "Flooder"}
+OTHER = {"telegramId": 2, "displayName": "Other"}
+
+
+async def main(args):
+    handled = []  # (telegramId, text) in the order the handler ran
+    finished = {}  # telegramId -> time its last update finished
+
+    async def slow_handler(update, context):
+        handled.append((update.effective_user.id, update.message.text))
+        await asyncio.sleep(args.handler_ms / 1000)
+        finished[update.effective_user.id] = time.perf_counter()
+
+    lanes = UserLanes(max_pending=args.flood // 2)  # The flood overflows the lane, nothing may be dropped
+    offline_bot = offline.OfflineBot()
+    application = (
+        Application.builder()
+        .application_class(LaneApplication, {"user_lanes": lanes, "running_updates": args.running})
+        .bot(offline_bot)
+        .concurrent_updates(10000)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, slow_handler))
+    await application.initialize()
+    await application.start()
+
+    for number in range(args.flood):
+        await application.update_queue.put(offline.message_update(offline_bot, FLOODER, f"flood {number}"))
+    await asyncio.sleep(0.01)  # The flood is in its lane before the other user's update arrives
+    sent_at = time.perf_counter()
+    await application.update_queue.put(offline.message_update(offline_bot, OTHER, "hello"))
+    while len(handled) < args.flood + 1:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(args.handler_ms / 1000 * 2)
+    await application.stop()
+    await application.shutdown()
+
+    waited = finished[OTHER["telegramId"]] - sent_at
+    # Worst case: a flooded update is running when the other user's arrives, then theirs runs
+    bound = 2 * args.handler_ms / 1000 + 0.05
+    flooded = [text for telegram_id, text in handled if telegram_id == FLOODER["telegramId"]]
+    print(f"other user's update took {waited * 1000:.0f} ms (bound {bound * 1000:.0f} ms), {len(flooded)} of {args.flood} flooded updates handled")
+
+    failed = False
+    if waited > bound:
+        print("  FAILED: the flood held back the other user")
+        failed = True
+    if flooded != [f"flood {number}" for number in range(args.flood)]:
+        print(f"  FAILED: flooded updates were dropped or reordered: {flooded}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--running", type=int, default=4, help="updates running at the same time (CONCURRENT_UPDATES)")
+    parser.add_argument("--flood", type=int, default=10, help="updates the flooding user sends at once")
+    parser.add_argument("--handler-ms", type=float, default=100.0, help="time each update takes")
+    sys.exit(asyncio.run(main(parser.parse_args())))
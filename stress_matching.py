@@ -0,0 +1,198 @@
+"""Concurrency stress test for match creation.
+
+Fires hundreds of simultaneous sport_selected calls against a local mongod and checks that every
+user ends up in at most one active Match, that the User flags agree with the Match collection, and
+that everyone still waiting in MongoDB is still in the bot's waiting pool and was told to wait. Every create_match call
+must also stay within CREATE_MATCH_BUDGET MongoDB round trips, contended or not.
+
+Usage: python stress_matching.py [--url mongodb://localhost:27017] [--users 400] [--rounds 3]
+"""
+import argparse
+import asyncio
+import os
+import sys
+from collections import Counter
+from types import SimpleNamespace
+
+SPORT = "Tennis"
+# Most MongoDB round trips of one create_match call: claiming both users and inserting the match when it
+# is created; a failed claim re-reads the unavailable users, after releasing the other one if it was claimed
+CREATE_MATCH_BUDGET = {"created": 2, "failed": 3}
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+class FakeCallbackQuery:
+    def __init__(self, user_id, data):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        pass
+
+
+def make_user(telegram_id):
+    # Everyone is compatible with everyone, so every searcher races for the same candidates
+    return {
+        "telegramId": telegram_id,
+        "username": f"stress{telegram_id}",
+        "displayName": f"Stress {telegram_id}",
+        "age": 20 + telegram_id % 10,
+        "gender": "Male" if telegram_id % 2 else "Female",
+        "sports": {SPORT: "Intermediate"},
+        "matchPreferences": {
+            SPORT: {
+                "ageRange": [18, 40],
+                "genderPreference": "No preference",
+                "skillLevels": [],
+                "locationPreferences": ["North", "Central"] if telegram_id % 3 else ["Central"],
+            }
+        },
+        "wantToBeMatched": False,
+        "isMatched": False,
+    }
+
+
+def check_invariants(db, user_ids, waiting_pool):
+    active_matches = list(db["Match"].find({"status": "active"}))
+    per_user = Counter()
+    for match in active_matches:
+        if match["userAId"] == match["userBId"]:
+            return f"match {match['_id']} pairs user {match['userAId']} with themselves"
+        per_user[match["userAId"]] += 1
+        per_user[match["userBId"]] += 1
+
+    doubled = [telegram_id for telegram_id, count in per_user.items() if count > 1]
+    if doubled:
+        return f"{len(doubled)} users are in more than one active match, e.g. {doubled[:5]}"
+
+    matched_flags = {user["telegramId"] for user in db["User"].find({"isMatched": True}, {"telegramId": 1})}
+    if matched_flags != set(per_user):
+        return (
+            f"isMatched disagrees with the Match collection: "
+            f"{len(matched_flags - set(per_user))} flagged without a match, "
+            f"{len(set(per_user) - matched_flags)} matched without the flag"
+        )
+
+    # A claim that failed only because of a concurrent one must not lose the user from the pool
+    waiting = {user["telegramId"] for user in db["User"].find({"wantToBeMatched": True, "isMatched": {"$ne": True}}, {"telegramId": 1})}
+    missing = waiting - set(waiting_pool.entries)
+    if missing:
+        return f"{len(missing)} users are waiting in MongoDB but missing from the waiting pool, e.g. {sorted(missing)[:5]}"
+    return None
+
+
+def count_create_match(bot, calls):
+    """Wrap bot.create_match to append the outcome and MongoDB round trips of every call to `calls`."""
+    from database import round_trips
+
+    create_match = bot.create_match
+
+    async def counted(user_a, user_b):
+        operations = Counter()
+        token = round_trips.set(operations)
+        try:
+            result = await create_match(user_a, user_b)
+        finally:
+            round_trips.reset(token)
+        calls.append(("created" if result is None else "failed", sum(operations.values()), dict(operations)))
+        return result
+
+    bot.create_match = counted
+
+
+def check_round_trips(calls):
+    for outcome, count, operations in calls:
+        if count > CREATE_MATCH_BUDGET[outcome]:
+            return f"create_match took {count} round trips ({outcome}), the budget is {CREATE_MATCH_BUDGET[outcome]}: {operations}"
+    return None
+
+
+async def run_round(bot, user_ids):
+    fake_bot = FakeBot()
+    context = SimpleNamespace(bot=fake_bot, user_data={})
+    updates = [SimpleNamespace(callback_query=FakeCallbackQuery(telegram_id, f"sport_{SPORT}")) for telegram_id in user_ids]
+
+    bot.outbox.start(fake_bot)
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    results = await asyncio.gather(*(bot.sport_selected(update, context) for update in updates), return_exceptions=True)
+    elapsed = loop.time() - started
+    await bot.outbox.stop()
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    notified = Counter(chat_id for chat_id, text in fake_bot.sent if text.startswith("You have been matched"))
+    told_to_wait = {chat_id for chat_id, text in fake_bot.sent if text.startswith("No match found")}
+    return elapsed, errors, notified, told_to_wait
+
+
+async def main(args):
+    # bot.py reads its configuration at import time
+    os.environ["DATABASE_URL"] = args.url
+    os.environ["DATABASE_NAME"] = args.db
+    os.environ.setdefault("BOT_TOKEN", "123456:stress-test")
+    # Notifications go to a fake bot, so Telegram's rate limits do not apply
+    os.environ["OUTBOX_GLOBAL_RATE"] = os.environ["OUTBOX_CHAT_RATE"] = "1000000"
+    import bot
+
+    create_match_calls = []
+    count_create_match(bot, create_match_calls)
+    db = bot.database.db
+    user_ids = list(range(1, args.users + 1))
+    failed = False
+
+    for round_number in range(1, args.rounds + 1):
+        bot.database.client.drop_database(args.db)
+        db["User"].insert_many([make_user(telegram_id) for telegram_id in user_ids])
+        for telegram_id in user_ids:
+            bot.waiting_pool.remove(telegram_id)
+
+        create_match_calls.clear()
+        elapsed, errors, notified, told_to_wait = await run_round(bot, user_ids)
+        problem = check_invariants(db, user_ids, bot.waiting_pool) or check_round_trips(create_match_calls)
+        double_notified = [chat_id for chat_id, count in notified.items() if count > 1]
+        if double_notified and not problem:
+            problem = f"{len(double_notified)} users were told they were matched more than once"
+        unanswered = set(user_ids) - set(notified) - told_to_wait
+        if unanswered and not problem:
+            problem = f"{len(unanswered)} users were neither matched nor told to wait, e.g. {sorted(unanswered)[:5]}"
+        if errors and not problem:
+            problem = f"{len(errors)} handlers raised, first error: {errors[0]!r}"
+
+        matches = db["Match"].count_documents({"status": "active"})
+        waiting = db["User"].count_documents({"wantToBeMatched": True})
+        most = {outcome: max((count for called, count, operations in create_match_calls if called == outcome), default=0) for outcome in CREATE_MATCH_BUDGET}
+        print(
+            f"round {round_number}: {args.users} concurrent taps in {elapsed:.2f}s -> {matches} matches, {waiting} still waiting, "
+            f"create_match round trips at most {most['created']} created / {most['failed']} failed"
+        )
+        if problem:
+            print(f"  FAILED: {problem}")
+            failed = True
+
+    bot.database.client.drop_database(args.db)
+    bot.database.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="mongodb://localhost:27017", help="local mongod to run against")
+    parser.add_argument("--db", default="sportsfinder_stress", help="scratch database, dropped before and after the run")
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.db == "test_database":
+        sys.exit("Refusing to run against the bot's own database")
+    sys.exit(asyncio.run(main(args)))
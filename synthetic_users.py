@@ -0,0 +1,45 @@
+import json
+import random
+
+
+SPORTS = ["Tennis", "Badminton", "Basketball", "Football", "Squash", "Table Tennis", "Volleyball", "Running"]
+SKILL_LEVELS = ["Beginner", "Intermediate", "Advanced"]
+GENDERS = ["Male", "Female"]
+LOCATIONS = ["North", "South", "East", "West", "Central", "North-East"]
+
+
+def generate_user(telegram_id, rng, json_string_fraction=0.5, waiting=False):
+    """A User document shaped like the ones written by the SportsFinder web apps."""
+    age = int(min(60, max(16, rng.gauss(27, 7))))
+    sports = {sport: rng.choice(SKILL_LEVELS) for sport in rng.sample(SPORTS, rng.randint(1, 3))}
+
+    match_preferences = {}
+    for sport in sports:
+        low = max(16, age - rng.randint(3, 10))
+        match_preferences[sport] = {
+            "ageRange": [low, low + rng.randint(8, 25)],
+            "genderPreference": rng.choices(["No preference", "Male", "Female"], weights=[6, 2, 2])[0],
+            "skillLevels": rng.sample(SKILL_LEVELS, rng.randint(0, 3)),
+            "locationPreferences": rng.sample(LOCATIONS, rng.randint(1, 3)),
+        }
+
+    selected_sport = rng.choice(list(sports))
+    return {
+        "telegramId": telegram_id,
+        "username": f"user{telegram_id}",
+        "displayName": f"Player {telegram_id}",
+        "age": age,
+        "gender": rng.choice(GENDERS),
+        "sports": sports,
+        # The web apps store matchPreferences as a JSON string, migrated users have a subdocument
+        "matchPreferences": json.dumps(match_preferences) if rng.random() < json_string_fraction else match_preferences,
+        "wantToBeMatched": waiting,
+        "selectedSport": selected_sport if waiting else None,
+        "isMatched": False,
+    }
+
+
+def generate_users(count, seed=0, first_id=100000, **kwargs):
+    """Reproducible population of `count` synthetic users."""
+    rng = random.Random(seed)
+    return [generate_user(first_id + index, rng, **kwargs) for index in range(count)]
@@ -0,0 +1,159 @@
+"""Opt-in recording of every incoming Update, for replaying production traffic locally (see replay.py).
+
+Each update is one compact JSON line, {"at": unix time, "update": Update.to_dict()}, appended to a log
+that rotates at `max_bytes`; rotated files are gzipped (update.jsonl.1.gz is the newest of them). Writing,
+rotating and compressing happen on a QueueListener thread, the event loop only serializes the update. With an
+anonymization key, user and chat ids are replaced by stable pseudonyms (the same user keeps the same id
+across files, so matches still pair up on replay), as are the match and partner ids inside feedback
+buttons (see callback_tokens.py), and names, phone numbers, locations and the text of anything but
+commands are blanked.
+"""
+from logging.handlers import QueueListener, RotatingFileHandler
+from bson import ObjectId
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import shutil
+import time
+
+import callback_tokens
+
+logger = logging.getLogger(__name__)
+
+# Objects in an update that describe a user or a chat
+PERSON_KEYS = ("from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat", "via_bot")
+# Free text written by users; commands are kept so replay takes the same handlers
+TEXT_KEYS = ("text", "caption")
+# Personal fields blanked wherever they appear
+REDACTED_KEYS = ("first_name", "last_name", "username", "phone_number", "title", "bio")
+# Button data, of a callback query or of the buttons of an inline keyboard
+CALLBACK_DATA_KEYS = ("data", "callback_data")
+# Fast compression of rotated logs: most of the size reduction of the default level 9 at a fraction of the time
+GZIP_LEVEL = 1
+
+
+def pseudonym(key, telegram_id):
+    """Stable positive id standing in for `telegram_id`, 48 bits so it stays a plain JSON number."""
+    digest = hmac.new(key, str(telegram_id).encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:6], "big") or 1
+
+
+def pseudonymous_match_id(key, match_id):
+    """Stable ObjectId standing in for a match's."""
+    return ObjectId(hmac.new(key, match_id.binary, hashlib.sha256).digest()[:12])
+
+
+def anonymize_callback_data(callback_data, key):
+    """callback_data with the match and user ids in feedback buttons replaced by pseudonyms."""
+    token = callback_tokens.rewrite_ids(
+        callback_data, lambda match_id: pseudonymous_match_id(key, match_id), lambda partner_id: pseudonym(key, partner_id)
+    )
+    if token is not None:
+        return token
+    # Buttons sent before the tokens were introduced: <question>_<answer>_<match id>
+    prefix, separator, match_id = callback_data.rpartition("_")
+    if separator and ObjectId.is_valid(match_id):
+        return f"{prefix}_{pseudonymous_match_id(key, ObjectId(match_id))}"
+    return callback_data
+
+
+def anonymize(data, key):
+    """Anonymized copy of an update dict (or any part of one)."""
+    if isinstance(data, list):
+        return [anonymize(item, key) for item in data]
+    if not isinstance(data, dict):
+        return data
+
+    anonymized = {}
+    for name, value in data.items():
+        if name in PERSON_KEYS and isinstance(value, dict):
+            value = dict(value)
+            if "id" in value:
+                value["id"] = pseudonym(key, value["id"])
+            anonymized[name] = anonymize(value, key)
+        elif name == "user_id" and isinstance(value, int):
+            anonymized[name] = pseudonym(key, value)
+        elif name in REDACTED_KEYS and isinstance(value, str):
+            anonymized[name] = "x" * len(value)
+        elif name in CALLBACK_DATA_KEYS and isinstance(value, str):
+            anonymized[name] = anonymize_callback_data(value, key)
+        elif name in TEXT_KEYS and isinstance(value, str):
+            anonymized[name] = value if value.startswith("/") else "x" * len(value)
+        elif name == "location" and isinstance(value, dict):
+            anonymized[name] = {**value, "latitude": 0.0, "longitude": 0.0}
+        else:
+            anonymized[name] = anonymize(value, key)
+    return anonymized
+
+
+def _gzip_rotated(source, destination):
+    with open(source, "rb") as plain, gzip.open(destination, "wb", compresslevel=GZIP_LEVEL) as compressed:
+        shutil.copyfileobj(plain, compressed)
+    os.remove(source)
+
+
+class UpdateRecorder:
+    """Appends updates to a rotating JSONL log. Register record() as a TypeHandler ahead of every other group."""
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backups=10, anonymize_key=None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.anonymize_key = anonymize_key
+        self.recorded = 0
+        self._file = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self._file.namer = lambda name: name + ".gz"
+        self._file.rotator = _gzip_rotated
+        self._file.setFormatter(logging.Formatter("%(message)s"))
+        self._queue = queue.SimpleQueue()
+        self._writer = QueueListener(self._queue, self._file)
+        self._writer.start()
+
+    async def record(self, update, context):
+        data = update.to_dict()
+        if self.anonymize_key is not None:
+            data = anonymize(data, self.anonymize_key)
+        line = json.dumps({"at": round(time.time(), 3), "update": data}, separators=(",", ":"), ensure_ascii=False)
+        # A log record, so the handler does the size check, rotation and locking for us, on the writer thread
+        self._queue.put(logging.makeLogRecord({"msg": line}))
+        self.recorded += 1
+
+    def close(self):
+        """Write the queued updates and close the log."""
+        self._writer.stop()
+        self._file.close()
+
+
+def read_updates(paths):
+    """Yield the (at, update dict) entries of recorded logs, plain or gzipped, file by file in the given order."""
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as log:
+            for line_number, line in enumerate(log, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a log cut short by a crash
+                    logger.warning("Skipping unreadable line %d of %s", line_number, path)
+                    continue
+                yield entry["at"], entry["update"]
+
+
+def log_files(path):
+    """A recorded log and its rotated files, oldest first."""
+    directory, name = os.path.split(path)
+    rotated = []
+    for file_name in os.listdir(directory or "."):
+        suffix = file_name[len(name) + 1:].removesuffix(".gz")
+        if file_name.startswith(name + ".") and suffix.isdigit():
+            rotated.append((int(suffix), os.path.join(directory, file_name)))
+    files = [file for number, file in sorted(rotated, reverse=True)]
+    if os.path.exists(path):
+        files.append(path)
+    return files
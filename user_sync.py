@@ -0,0 +1,204 @@
+"""Keeps the bot's in-memory user state in step with User documents changed outside the bot.
+
+Profiles and match preferences are edited by the web apps, which write to the User collection directly.
+UserSync hands every changed User document to a callback, which updates the caches and the waiting pool.
+Changes come from a change stream (replica sets, Atlas), or from polling the `updatedAt` field of the
+documents where change streams are not available.
+
+Run `python user_sync.py --url "mongodb://localhost:27017/?replicaSet=rs0"` to check both modes against a
+local single-node replica set: it edits a scratch user and waits for the change to arrive, then checks
+that polling gets through a bulk update giving more than a batch of users the same updatedAt.
+"""
+from pymongo.errors import OperationFailure, PyMongoError
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Only these operations carry a User document to apply
+WATCHED_OPERATIONS = ["insert", "update", "replace"]
+# Polling order: many users can share one updatedAt (bulk updates, migrations), _id tells them apart
+POLL_ORDER = [("updatedAt", 1), ("_id", 1)]
+
+
+class UserSync:
+    """Calls `on_change(user)` for every User document changed after start().
+
+    mode is "change_stream", "poll", or "auto" (a change stream when the server supports it, polling otherwise).
+    """
+
+    def __init__(self, database, on_change, mode="auto", poll_interval=5.0, poll_batch=500):
+        self.database = database  # AsyncDatabase
+        self.on_change = on_change
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.poll_batch = poll_batch
+        self.active_mode = None
+        self._loop = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._task = None
+        self._resume_token = None
+        self._high_water = None  # (updatedAt, _id) of the last user the poller applied
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        if self.mode in ("auto", "change_stream"):
+            try:
+                stream = await self.database.run(self._open_stream)
+            except OperationFailure as e:
+                if self.mode == "change_stream":
+                    raise
+                logger.info("Change streams are not available (%s), polling updatedAt instead", e)
+            else:
+                self.active_mode = "change_stream"
+                self._thread = threading.Thread(target=self._watch, args=(stream,), name="user-sync", daemon=True)
+                self._thread.start()
+                logger.info("Following User changes through a change stream")
+                return
+
+        self.active_mode = "poll"
+        latest = await self.database.collection("User").find(
+            {"updatedAt": {"$ne": None}}, {"updatedAt": 1}, sort=[(field, -1) for field, order in POLL_ORDER], limit=1
+        )
+        self._high_water = (latest[0]["updatedAt"], latest[0]["_id"]) if latest else None
+        self._task = asyncio.create_task(self._poll())
+        logger.info("Following User changes by polling updatedAt every %ss", self.poll_interval)
+
+    async def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _apply(self, user):
+        try:
+            self.on_change(user)
+        except Exception:
+            logger.exception("Error applying a change to user %s", user.get("telegramId"))
+
+    # Change stream, followed on its own thread so it never holds one of the database pool's threads
+    def _open_stream(self):
+        return self.database.db["User"].watch(
+            [{"$match": {"operationType": {"$in": WATCHED_OPERATIONS}}}],
+            full_document="updateLookup",
+            resume_after=self._resume_token,
+            max_await_time_ms=1000,  # Wake up every second to check for stop()
+        )
+
+    def _watch(self, stream):
+        while not self._stopped.is_set():
+            try:
+                with stream:
+                    while not self._stopped.is_set():
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        self._resume_token = stream.resume_token
+                        if change.get("fullDocument") is not None:
+                            self._loop.call_soon_threadsafe(self._apply, change["fullDocument"])
+            except PyMongoError as e:
+                logger.warning("User change stream failed, resuming: %s", e)
+                time.sleep(1)
+            if not self._stopped.is_set():
+                try:
+                    stream = self._open_stream()
+                except PyMongoError as e:
+                    logger.warning("Could not reopen the User change stream: %s", e)
+                    time.sleep(5)
+
+    # Polling fallback: everything after the high-water mark, in (updatedAt, _id) order
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.poll_once()
+            except Exception:
+                logger.exception("Error polling for User changes")
+
+    async def poll_once(self):
+        """Apply everything changed since the last poll. Returns how many users were applied."""
+        applied = 0
+        while True:
+            if self._high_water is None:
+                query = {"updatedAt": {"$ne": None}}
+            else:
+                updated_at, last_id = self._high_water
+                query = {"$or": [{"updatedAt": {"$gt": updated_at}}, {"updatedAt": updated_at, "_id": {"$gt": last_id}}]}
+            users = await self.database.collection("User").find(query, sort=POLL_ORDER, limit=self.poll_batch)
+            for user in users:
+                self._high_water = (user["updatedAt"], user["_id"])
+                self._apply(user)
+            applied += len(users)
+            # A full batch may have more behind it
+            if len(users) < self.poll_batch:
+                return applied
+
+
+async def check(args):
+    """Edit a scratch user and wait until each mode reports the change."""
+    import datetime
+    from database import AsyncDatabase
+
+    database = AsyncDatabase(args.url, args.db)
+    users = database.db["User"]
+    failed = False
+    for mode in ("change_stream", "poll"):
+        users.delete_many({})
+        users.insert_one({"telegramId": 1, "displayName": "Before", "updatedAt": datetime.datetime.utcnow()})
+        received = asyncio.Queue()
+        sync = UserSync(database, received.put_nowait, mode=mode, poll_interval=0.5)
+        try:
+            await sync.start()
+        except OperationFailure as e:
+            print(f"{mode}: not available on this server ({e})")
+            failed = True
+            continue
+
+        users.update_one({"telegramId": 1}, {"$set": {"displayName": "After", "updatedAt": datetime.datetime.utcnow()}})
+        try:
+            user = await asyncio.wait_for(received.get(), timeout=10)
+            print(f"{mode}: received the change, displayName={user['displayName']}")
+            failed |= user["displayName"] != "After"
+        except asyncio.TimeoutError:
+            print(f"{mode}: no change arrived within 10s")
+            failed = True
+        await sync.stop()
+
+    # A bulk update gives more than a batch of users the same updatedAt, polling must page through all of them
+    users.delete_many({})
+    received = []
+    sync = UserSync(database, received.append, mode="poll", poll_interval=3600, poll_batch=10)
+    await sync.start()
+    users.insert_many([{"telegramId": telegram_id, "displayName": "Before"} for telegram_id in range(sync.poll_batch + 1)])
+    users.update_many({}, {"$set": {"displayName": "After", "updatedAt": datetime.datetime.utcnow()}})
+    applied = await sync.poll_once() + await sync.poll_once()
+    await sync.stop()
+    print(f"poll: {applied} of {sync.poll_batch + 1} users sharing one updatedAt applied")
+    failed |= sorted(user["telegramId"] for user in received) != list(range(sync.poll_batch + 1))
+
+    database.client.drop_database(args.db)
+    database.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Check that User changes reach the bot, in both modes")
+    parser.add_argument("--url", default="mongodb://localhost:27017/?replicaSet=rs0", help="local single-node replica set")
+    parser.add_argument("--db", default="sportsfinder_sync_check", help="scratch database, dropped after the run")
+    args = parser.parse_args()
+    if args.db == "test_database":
+        sys.exit("Refusing to run against the bot's own database")
+    sys.exit(asyncio.run(check(args)))
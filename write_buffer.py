@@ -0,0 +1,135 @@
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Coalesces low-priority writes in memory and flushes them to MongoDB in bulk.
+
+    Handlers queue a write and return without a round trip. A background task flushes every `interval`
+    seconds, or as soon as `max_batch` writes are waiting, with one bulk_write/insert_many per collection.
+    Several $set writes to the same document are merged into a single update.
+
+    Writes only live in memory until they are flushed, so a crash loses at most `interval` seconds or
+    `max_queued` writes, whichever is less. Once `max_queued` writes are waiting, queueing another one
+    waits for a flush instead of growing the buffer.
+    """
+
+    def __init__(self, interval=2.0, max_batch=500, max_queued=5000):
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_queued = max_queued
+        self.queued = 0
+        self._collections = {}  # collection name -> AsyncCollection
+        self._updates = {}  # collection name -> {filter key: (filter, fields to $set)}
+        self._inserts = {}  # collection name -> [document]
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and flush everything still waiting."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.queued:
+            logger.error("Write buffer stopped with %d writes that could not be flushed", self.queued)
+
+    async def set_fields(self, collection, filter, fields):
+        """Queue `{"$set": fields}` on the document matching `filter` (an equality filter, e.g. on _id)."""
+        key = tuple(sorted(filter.items()))
+        pending = self._updates.setdefault(collection.name, {})
+        if key in pending:
+            pending[key][1].update(fields)
+            return
+        self._collections[collection.name] = collection
+        pending[key] = (filter, dict(fields))
+        await self._queued_one()
+
+    async def insert_one(self, collection, document):
+        self._collections[collection.name] = collection
+        self._inserts.setdefault(collection.name, []).append(document)
+        await self._queued_one()
+
+    async def _queued_one(self):
+        self.queued += 1
+        if self.queued >= self.max_queued:
+            await self.flush()
+        elif self.queued >= self.max_batch and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error flushing the write buffer")
+
+    async def flush(self):
+        async with self._flush_lock:
+            updates, self._updates = self._updates, {}
+            inserts, self._inserts = self._inserts, {}
+            self.queued = 0
+
+            for name, pending in updates.items():
+                entries = list(pending.values())
+                for start in range(0, len(entries), self.max_batch):
+                    batch = entries[start:start + self.max_batch]
+                    requests = [UpdateOne(filter, {"$set": fields}) for filter, fields in batch]
+                    if not await self._write(name, "bulk_write", requests):
+                        self._requeue_updates(name, batch)
+
+            for name, documents in inserts.items():
+                for start in range(0, len(documents), self.max_batch):
+                    batch = documents[start:start + self.max_batch]
+                    if not await self._write(name, "insert_many", batch):
+                        self._requeue_inserts(name, batch)
+
+    async def _write(self, name, method, batch):
+        """Run one bulk call. Returns False if it should be retried on the next flush."""
+        try:
+            await getattr(self._collections[name], method)(batch, ordered=False)
+        except BulkWriteError as e:
+            # The server rejected some of the writes themselves, retrying would fail the same way
+            logger.error("%d of %d buffered writes to %s failed: %s", len(e.details.get("writeErrors", [])), len(batch), name, e)
+        except PyMongoError as e:
+            logger.warning("Flushing %d buffered writes to %s failed, retrying on the next flush: %s", len(batch), name, e)
+            return False
+        return True
+
+    def _requeue_updates(self, name, batch):
+        pending = self._updates.setdefault(name, {})
+        for filter, fields in batch:
+            key = tuple(sorted(filter.items()))
+            if key in pending:
+                # Writes queued since the failed flush are newer and win
+                pending[key] = (filter, {**fields, **pending[key][1]})
+            elif self.queued < self.max_queued:
+                pending[key] = (filter, fields)
+                self.queued += 1
+            else:
+                logger.error("Write buffer is full, dropping a write to %s", name)
+
+    def _requeue_inserts(self, name, batch):
+        room = max(0, self.max_queued - self.queued)
+        if len(batch) > room:
+            logger.error("Write buffer is full, dropping %d inserts into %s", len(batch) - room, name)
+        self._inserts[name] = batch[:room] + self._inserts.get(name, [])
+        self.queued += min(len(batch), room)